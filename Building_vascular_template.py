@@ -0,0 +1,203 @@
+""" Population vascular template by iterative group-wise registration of the TOF (or CTA) of all subjects.
+
+The template starts as the reference subject (the first one, unless given) resampled to an isotropic
+template_spacing_mm grid. Every iteration
+    1. registers every subject (moving) to the current template (fixed) with Registering_batch.run_jobs, in a
+       process pool sized by Scheduling_registration.py, and resamples it onto the template grid,
+    2. averages the resampled subjects, each scaled by its 99th intensity percentile so that scanners with
+       different intensity ranges weigh the same, over the subjects that cover the voxel (a TOF slab does not
+       cover the whole head),
+    3. for linear stages, moves the average by the inverse of the mean subject transform, so that the template
+       stays in the mean position and size of the population instead of drifting with the reference,
+and writes template_<iteration>.nii.gz. The iterations stop early once the template changes by less than
+template_tolerance (RMS change relative to the RMS of the template).
+
+Costs at scale: every subject is one registration job per iteration, so hundreds of subjects are
+iterations * subjects jobs. The default schedule keeps them linear and short (fast preset, moment
+initializer, resolution matching of the fine TOF/CTA to the template spacing), the subjects of an iteration
+share an iteration budget group (see Monitoring_convergence.py), and the average is accumulated one image at
+a time, so memory does not grow with the number of subjects.
+Registrations are cached by content (see Caching_registration.py): a rebuild, or a build resumed after an
+interruption, reruns only the registrations whose template or subject changed, e.g. adding subjects keeps
+every registration to the reference subject of the first iteration.
+
+Measured on 4 phantom subjects of Registration_presets.py (1 core, 1 mm template): about 35 s per iteration,
+i.e. 9 s per subject registration and resampling, 4 iterations in 140 s; the same build rerun from the cache
+took 13 s. A night for N subjects on C cores is then roughly iterations * N * (seconds per subject) / C,
+with the seconds per subject measured on a few real subjects first.
+
+Usage: python Building_vascular_template.py <output folder> <series index> <role> [number of parallel jobs | auto]
+           e.g. python Building_vascular_template.py /data/golubeka/EBRAINS/Templates/tof <index> tof
+       python Building_vascular_template.py <output folder> --synthetic <folder>   (phantoms of
+           Registration_presets.py)"""
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from Composing_transforms import fold_linear, linear_matrix, load_chain
+from Registering_batch import num_workers, run_jobs, summarize
+
+# Grid of the template: isotropic, in mm
+template_spacing_mm = 1.0
+
+# Stages of every iteration: rigid first, so that the first average is not blurred by scaling differences
+iteration_stages = [["rigid"], ["rigid", "affine"], ["rigid", "affine"], ["rigid", "affine"]]
+
+# Job settings of the subject registrations
+subject_job = {"preset": "fast", "initializer": "moments", "result_interpolator": "linear"}
+
+# The iterations stop once the template changes by less than this (relative RMS change)
+template_tolerance = 0.01
+
+# Subjects are scaled by this intensity percentile (of their non-zero voxels) before averaging
+normalization_percentile = 99
+
+# Function to list the subjects of the series index
+def subjects_from_index(index_file, role):
+    """One subject per patient with a converted series of the role, the largest matrix if several."""
+    from Indexing_series import find_series, open_index
+    subjects = {}
+    with open_index(index_file) as conn:
+        for row in find_series(conn, role=role):
+            subjects.setdefault(row["patient"], {"name": f"{role}_{row['patient']}", "image": row["nifti_path"]})
+    return list(subjects.values())
+
+# Functions for the template images
+def initial_template(reference_path, spacing=template_spacing_mm):
+    """The reference subject resampled to an isotropic grid over the same extent."""
+    reference = sitk.ReadImage(reference_path, sitk.sitkFloat32)
+    size = [int(round(n * s / spacing)) for n, s in zip(reference.GetSize(), reference.GetSpacing())]
+    grid = sitk.Image(size, sitk.sitkFloat32)
+    grid.SetSpacing([spacing] * 3)
+    grid.SetOrigin(reference.GetOrigin())
+    grid.SetDirection(reference.GetDirection())
+    smoothed = sitk.SmoothingRecursiveGaussian(reference, spacing / 2) if spacing > min(reference.GetSpacing()) \
+        else reference
+    return _normalized(sitk.Resample(smoothed, grid, sitk.Transform(), sitk.sitkLinear, 0.0))
+
+def _normalized(image):
+    values = sitk.GetArrayViewFromImage(image)
+    scale = np.percentile(values[values > 0], normalization_percentile) if np.any(values > 0) else 1.0
+    return image / float(scale) if scale > 0 else image
+
+def average_images(paths, reference):
+    """Mean of the normalized images (all on the grid of reference) over the images that cover each voxel."""
+    total = np.zeros(sitk.GetArrayViewFromImage(reference).shape, np.float64)
+    coverage = np.zeros(total.shape, np.uint32)
+    for path in paths:
+        values = sitk.GetArrayFromImage(_normalized(sitk.ReadImage(path, sitk.sitkFloat32)))
+        total += values
+        coverage += values != 0
+    template = sitk.GetImageFromArray((total / np.maximum(coverage, 1)).astype(np.float32))
+    template.CopyInformation(reference)
+    return template, float(np.mean(coverage > 0))
+
+def recenter(template, chains):
+    """Moves the template by the inverse of the mean subject transform (fixed -> moving matrices) when all
+    chains are linear; returns the template unchanged otherwise. The mean of the matrices approximates the
+    mean transform for the small rotations between subjects and template."""
+    matrices = []
+    for chain in chains:
+        folded = fold_linear(chain)
+        matrix = linear_matrix(folded[0]) if len(folded) == 1 else None
+        if matrix is None:
+            return template
+        matrices.append(matrix)
+    # new template(y) = template(M^-1 y), so that the subject transforms M_i M^-1 average to the identity
+    inverse = np.linalg.inv(np.mean(matrices, axis=0))
+    transform = sitk.AffineTransform(3)
+    transform.SetMatrix(inverse[:3, :3].ravel().tolist())
+    transform.SetTranslation(inverse[:3, 3].tolist())
+    return sitk.Resample(template, template, transform, sitk.sitkLinear, 0.0)
+
+def template_change(previous, template):
+    """RMS of the change relative to the RMS of the new template."""
+    a, b = sitk.GetArrayViewFromImage(previous), sitk.GetArrayViewFromImage(template)
+    return float(np.sqrt(np.mean((b - a) ** 2)) / max(np.sqrt(np.mean(b ** 2)), 1e-12))
+
+# Function for the registration jobs of one iteration
+def template_jobs(subjects, template_path, iteration_folder, stages, budget_group):
+    return [dict(subject_job, name=subject["name"], fixed=template_path, moving=subject["image"],
+                 output_folder=iteration_folder, stages=list(stages), iteration_budget=budget_group,
+                 outputs={"result_image": os.path.join(iteration_folder, "registered", f"{subject['name']}.nii.gz")})
+            for subject in subjects]
+
+# Function to build the template
+def build_template(subjects, output_folder, stages=iteration_stages, workers=num_workers, reference=None,
+                   spacing=template_spacing_mm, tolerance=template_tolerance):
+    """Builds the template of the subjects ({"name", "image"}) in output_folder and returns the path of the
+    last template. workers is the number of parallel registrations, or "auto" for Scheduling_registration.py."""
+    os.makedirs(output_folder, exist_ok=True)
+    reference = reference or subjects[0]["image"]
+    template_path = os.path.join(output_folder, "template_0.nii.gz")
+    template = initial_template(reference, spacing)
+    sitk.WriteImage(template, template_path, useCompression=True)
+    history = {"subjects": subjects, "reference": reference, "iterations": []}
+
+    for iteration, stage_names in enumerate(stages, start=1):
+        start_time = time.time()
+        iteration_folder = os.path.join(output_folder, f"iteration_{iteration}")
+        jobs = template_jobs(subjects, template_path, iteration_folder, stage_names,
+                             budget_group=f"template_{'_'.join(stage_names)}")
+        if workers == "auto":
+            from Scheduling_registration import schedule
+            jobs, iteration_workers = schedule(jobs)
+        else:
+            iteration_workers = workers
+        results = run_jobs(jobs, iteration_workers)
+        done = [(job, result) for job, result in zip(jobs, results) if result["status"] == "ok"]
+        for result in results:
+            if result["status"] != "ok":
+                logging.error(f"Template iteration {iteration}: {result['name']} failed: {result['error']}")
+        if not done:
+            raise RuntimeError(f"Template iteration {iteration}: every registration failed")
+
+        previous = template
+        template, covered = average_images([result["result_image"] for _, result in done], previous)
+        template = recenter(template, [load_chain(result["transform_files"][-1]) for _, result in done])
+        template_path = os.path.join(output_folder, f"template_{iteration}.nii.gz")
+        sitk.WriteImage(template, template_path, useCompression=True)
+
+        change = template_change(previous, template)
+        summary = summarize(results)
+        history["iterations"].append({
+            "iteration": iteration, "stages": stage_names, "template": template_path,
+            "registered": len(done), "failed": summary["failed"],
+            "cached": sum(1 for result in results if result.get("cached")),
+            "change": round(change, 5), "covered_fraction": round(covered, 4),
+            "seconds": round(time.time() - start_time, 1),
+        })
+        with open(os.path.join(output_folder, "template.json"), "w") as f:
+            json.dump(history, f, indent=1)
+        print(f"Iteration {iteration}: {len(done)} of {len(jobs)} subjects registered "
+              f"({history['iterations'][-1]['cached']} cached), template change {change:.4f}, "
+              f"{history['iterations'][-1]['seconds']} seconds")
+        if change < tolerance:
+            break
+    return template_path
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(filename="template_errors.log", level=logging.ERROR, format="%(asctime)s - %(message)s")
+    start_time = time.time()
+    output_folder = sys.argv[1]
+    if sys.argv[2] == "--synthetic":
+        import yaml
+        from Registration_presets import make_synthetic_reference_set
+        with open(make_synthetic_reference_set(sys.argv[3])) as f:
+            cases = yaml.safe_load(f)["cases"]
+        subjects = [{"name": case["name"], "image": case["moving"]} for case in cases]
+        workers = num_workers
+    else:
+        subjects = subjects_from_index(sys.argv[2], sys.argv[3])
+        workers = int(sys.argv[4]) if len(sys.argv) > 4 and sys.argv[4] != "auto" else "auto"
+    if not subjects:
+        raise ValueError("No subjects to build a template of")
+
+    template_path = build_template(subjects, output_folder, workers=workers)
+    print(f"Template of {len(subjects)} subjects written to {template_path} in {time.time() - start_time:.2f} seconds")
@@ -0,0 +1,128 @@
+""" Content-addressed cache of registration results.
+
+The key of a registration is the sha256 of
+    - the fixed image: pixel data and header (size, pixel type, spacing, origin, direction)
+    - the moving image: the same
+    - the serialized parameter maps and the options that change the result (resolution matching, the
+      digests of the fixed and moving masks)
+so a renamed or re-converted but identical image still hits, and any change of data or parameters misses.
+An entry holds the TransformParameters.<i>.txt chain and, once resampled, the result image per interpolator:
+    <cache_folder>/<key[:2]>/<key>/TransformParameters.<i>.txt, result_<interpolator><extension>, entry.json
+
+Hashing the pixel data means reading the image, so the digests are also kept in image_digests.json in the
+cache folder, by path, size and modification time: a cache hit on unchanged files reads no image at all.
+Registering_batch.run_job uses the cache unless the job sets cache: false."""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import SimpleITK as sitk
+
+digest_index_name = "image_digests.json"
+
+# Functions to hash images
+def _image_digest(path):
+    image = sitk.ReadImage(path)
+    h = hashlib.sha256()
+    header = {
+        "size": image.GetSize(),
+        "pixel_type": image.GetPixelIDTypeAsString(),
+        "components": image.GetNumberOfComponentsPerPixel(),
+        "spacing": image.GetSpacing(),
+        "origin": image.GetOrigin(),
+        "direction": image.GetDirection(),
+    }
+    h.update(json.dumps(header, sort_keys=True).encode())
+    h.update(sitk.GetArrayViewFromImage(image).tobytes())
+    return h.hexdigest()
+
+def image_digest(path, cache_folder):
+    """sha256 of the pixel data and header of an image, memoized by path, size and modification time."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    index_file = os.path.join(cache_folder, digest_index_name)
+    index = {}
+    if os.path.exists(index_file):
+        try:
+            with open(index_file) as f:
+                index = json.load(f)
+        except ValueError:  # written by another process at the same time
+            index = {}
+    if path in index and index[path]["stamp"] == stamp:
+        return index[path]["digest"]
+
+    digest = _image_digest(path)
+    index[path] = {"stamp": stamp, "digest": digest}
+    os.makedirs(cache_folder, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=cache_folder, suffix=".tmp", delete=False) as f:
+        json.dump(index, f)
+    os.replace(f.name, index_file)
+    return digest
+
+# Function to compute the key of a registration
+def registration_key(fixed_path, moving_path, parameter_maps, options, cache_folder):
+    """Key of a registration: image digests, parameter maps (as given to elastix) and result options."""
+    h = hashlib.sha256()
+    h.update(image_digest(fixed_path, cache_folder).encode())
+    h.update(image_digest(moving_path, cache_folder).encode())
+    h.update(json.dumps([sorted((key, list(value)) for key, value in dict(parameter_map).items())
+                         for parameter_map in parameter_maps]).encode())
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+def entry_folder(key, cache_folder):
+    return os.path.join(cache_folder, key[:2], key)
+
+# Functions to read and write entries
+def lookup(key, cache_folder):
+    """Returns the transform parameter files of the entry, or None on a miss."""
+    folder = entry_folder(key, cache_folder)
+    if not os.path.exists(os.path.join(folder, "entry.json")):
+        return None
+    with open(os.path.join(folder, "entry.json")) as f:
+        entry = json.load(f)
+    return [os.path.join(folder, name) for name in entry["transform_files"]]
+
+def _result_name(interpolator, path):
+    extension = ".nii.gz" if path.endswith(".nii.gz") else os.path.splitext(path)[1]
+    return f"result_{interpolator}{extension}"
+
+def cached_result_image(key, cache_folder, interpolator, result_image_path):
+    """Path of the cached result image in the format of result_image_path, or None."""
+    path = os.path.join(entry_folder(key, cache_folder), _result_name(interpolator, result_image_path))
+    return path if os.path.exists(path) else None
+
+def store(key, cache_folder, transform_files, job_name):
+    """Copies the transform parameter files of a finished registration into a new entry."""
+    folder = entry_folder(key, cache_folder)
+    if os.path.exists(os.path.join(folder, "entry.json")):
+        return folder
+    os.makedirs(os.path.dirname(folder), exist_ok=True)
+    staging = tempfile.mkdtemp(dir=os.path.dirname(folder), prefix=".tmp_")
+    names = []
+    for path in transform_files:
+        names.append(os.path.basename(path))
+        shutil.copyfile(path, os.path.join(staging, names[-1]))
+    with open(os.path.join(staging, "entry.json"), "w") as f:
+        json.dump({"transform_files": names, "job": job_name, "created": time.strftime("%Y-%m-%d %H:%M:%S")}, f)
+    try:
+        os.replace(staging, folder)
+    except OSError:  # stored by another job in the meantime
+        shutil.rmtree(staging, ignore_errors=True)
+    return folder
+
+def store_result_image(key, cache_folder, interpolator, result_image_path):
+    """Adds a resampled result image to an existing entry."""
+    folder = entry_folder(key, cache_folder)
+    if os.path.isdir(folder):
+        target = os.path.join(folder, _result_name(interpolator, result_image_path))
+        # a unique temporary file: parallel jobs with the same key may store the same result
+        with tempfile.NamedTemporaryFile(dir=folder, suffix=".tmp", delete=False) as f:
+            pass
+        shutil.copyfile(result_image_path, f.name)
+        os.replace(f.name, target)
@@ -0,0 +1,211 @@
+""" Composition of stored elastix transforms, e.g. TOF -> atlas from TOF -> T1 and T1 -> atlas.
+
+A registration of moving to fixed gives a transform from fixed points to moving points (that is how the
+moving image is resampled onto the fixed grid). Registrations named by image direction compose backwards:
+    TOF -> T1    gives  T_a: x_T1    -> x_TOF
+    T1 -> atlas  gives  T_b: x_atlas -> x_T1
+    TOF -> atlas      = T_a(T_b(x_atlas)), i.e. the elastix chain [T_b maps..., T_a maps...]
+so every new modality needs one registration to a reference of the subject, not one per target space.
+
+Runs of linear maps (translation, Euler, similarity, affine) are folded into one AffineTransform map, and
+the composed chain is applied by transformix in a single resampling pass.
+
+Usage: python Composing_transforms.py <output folder> <job folder TOF->T1> <job folder T1->atlas> [...]
+           [--moving <image> --result <registered image>]
+The job folders are those written by Registering_batch.py (with job.json and TransformParameters.<i>.txt)."""
+
+import json
+import os
+import tempfile
+
+import numpy as np
+import SimpleITK as sitk
+
+from Registering_batch import resample, write_transform_chain
+
+# Elastix map keys of the chain link; older elastix versions spell it with "Parameters"
+initial_transform_keys = ("InitialTransformParameterFileName", "InitialTransformParametersFileName")
+
+# Functions to read stored chains
+def load_chain(path):
+    """Returns the maps of a TransformParameters file and of its initial transforms, first applied first."""
+    chain = []
+    while path and path != "NoInitialTransform":
+        transform_map = sitk.ReadParameterFile(path)
+        chain.insert(0, transform_map)
+        values = dict(transform_map)
+        initial = next((values[key][0] for key in initial_transform_keys if key in values), "NoInitialTransform")
+        if initial != "NoInitialTransform" and not os.path.isabs(initial) and not os.path.exists(initial):
+            initial = os.path.join(os.path.dirname(path), initial)  # relative to the file, not to the working directory
+        path = initial
+    return chain
+
+def load_job_chain(folder):
+    """Chain of maps of a job folder of Registering_batch.py."""
+    with open(os.path.join(folder, "job.json")) as f:
+        result = json.load(f)
+    if result["status"] != "ok":
+        raise ValueError(f"Registration {result['name']} did not finish: {result['error']}")
+    return load_chain(result["transform_files"][-1])
+
+# Functions for the matrices of linear maps
+def _rotation_x(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+def _rotation_y(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+def _rotation_z(angle):
+    c, s = np.cos(angle), np.sin(angle)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+def _versor_matrix(versor):
+    x, y, z = versor
+    w = np.sqrt(max(0.0, 1.0 - x * x - y * y - z * z))
+    return np.array([
+        [1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+        [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+        [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)],
+    ])
+
+def linear_matrix(transform_map):
+    """4x4 matrix of the point mapping (fixed -> moving) of a linear 3D elastix map, or None if not linear."""
+    values = dict(transform_map)
+    if values.get("HowToCombineTransforms", ("Compose",))[0] != "Compose" or values["FixedImageDimension"][0] != "3":
+        return None
+    kind = values["Transform"][0]
+    if kind not in ("TranslationTransform", "EulerTransform", "SimilarityTransform", "AffineTransform"):
+        return None
+    p = np.array(values["TransformParameters"], float)
+    center = np.array(values.get("CenterOfRotationPoint", ("0", "0", "0")), float)
+    if kind == "TranslationTransform":
+        A, t = np.eye(3), p[:3]
+    elif kind == "EulerTransform":
+        if values.get("ComputeZYX", ("false",))[0] == "true":
+            A = _rotation_z(p[2]) @ _rotation_y(p[1]) @ _rotation_x(p[0])
+        else:
+            A = _rotation_z(p[2]) @ _rotation_x(p[0]) @ _rotation_y(p[1])
+        t = p[3:6]
+    elif kind == "SimilarityTransform":
+        A, t = p[6] * _versor_matrix(p[:3]), p[3:6]
+    else:
+        A, t = p[:9].reshape(3, 3), p[9:12]
+    # x -> A (x - c) + t + c
+    matrix = np.eye(4)
+    matrix[:3, :3] = A
+    matrix[:3, 3] = t + center - A @ center
+    return matrix
+
+def affine_map(matrix, template):
+    """Elastix AffineTransform map of a 4x4 point mapping, with the image settings of the template map."""
+    transform_map = sitk.ParameterMap(template)
+    transform_map["Transform"] = ["AffineTransform"]
+    transform_map["NumberOfParameters"] = ["12"]
+    transform_map["TransformParameters"] = [repr(float(v)) for v in list(matrix[:3, :3].ravel()) + list(matrix[:3, 3])]
+    transform_map["CenterOfRotationPoint"] = ["0.0", "0.0", "0.0"]
+    transform_map["HowToCombineTransforms"] = ["Compose"]
+    for key in initial_transform_keys + ("ComputeZYX",):
+        if key in dict(transform_map):
+            del transform_map[key]
+    return transform_map
+
+# Functions to compose and fold chains
+def fold_linear(chain):
+    """Replaces every run of consecutive linear maps by one AffineTransform map."""
+    folded, run = [], []
+    for transform_map in list(chain) + [None]:
+        matrix = linear_matrix(transform_map) if transform_map is not None else None
+        if matrix is not None:
+            run.append((matrix, transform_map))
+            continue
+        if len(run) == 1:
+            folded.append(run[0][1])
+        elif run:
+            total = np.eye(4)
+            for matrix_i, _ in run:
+                total = matrix_i @ total  # later maps are applied after earlier ones
+            folded.append(affine_map(total, run[-1][1]))
+        run = []
+        if transform_map is not None:
+            folded.append(transform_map)
+    return folded
+
+def compose_registrations(*chains, fold=True):
+    """Composes registrations given in image direction, e.g. compose_registrations(tof_to_t1, t1_to_atlas)
+    for TOF -> atlas. Returns the elastix chain (first applied first), resampling onto the grid of the last
+    registration's fixed image."""
+    composed = [transform_map for chain in reversed(chains) for transform_map in chain]
+    if fold:
+        composed = fold_linear(composed)
+    return _with_output_grid(composed, chains[-1][-1])
+
+def _with_output_grid(chain, grid_map):
+    """Copies the fixed image grid of grid_map into every map of the chain."""
+    values = dict(grid_map)
+    chain = [sitk.ParameterMap(transform_map) for transform_map in chain]
+    for transform_map in chain:
+        for key in ("Size", "Index", "Spacing", "Origin", "Direction"):
+            transform_map[key] = values[key]
+    return chain
+
+# Functions to map points through a chain
+def deformation_field(chain):
+    """Displacement field (x -> x + u(x), fixed to moving points) of the chain on the grid of its last map,
+    computed by transformix."""
+    values = dict(chain[-1])
+    grid = sitk.Image([int(n) for n in values["Size"]], sitk.sitkFloat32)
+    grid.SetSpacing([float(s) for s in values["Spacing"]])
+    grid.SetOrigin([float(o) for o in values["Origin"]])
+    grid.SetDirection([float(d) for d in values["Direction"]])
+    transformix = sitk.TransformixImageFilter()
+    transformix.LogToConsoleOff()
+    transformix.ComputeDeformationFieldOn()
+    transformix.SetMovingImage(grid)
+    transformix.SetTransformParameterMap(chain[0])
+    for transform_map in chain[1:]:
+        transformix.AddTransformParameterMap(transform_map)
+    # transformix also writes the field as deformationField.nii into its output directory
+    with tempfile.TemporaryDirectory() as folder:
+        transformix.SetOutputDirectory(folder)
+        transformix.Execute()
+        return sitk.Cast(transformix.GetDeformationField(), sitk.sitkVectorFloat64)
+
+def transform_points(chain, points):
+    """Maps physical points (N x 3, fixed space) through the chain to moving space: exactly with the folded
+    matrix for linear chains, else through the deformation field of transformix on the fixed grid."""
+    points = np.asarray(points, float)
+    folded = fold_linear(chain)
+    matrix = linear_matrix(folded[0]) if len(folded) == 1 else None
+    if matrix is not None:
+        return points @ matrix[:3, :3].T + matrix[:3, 3]
+    field = sitk.DisplacementFieldTransform(deformation_field(chain))
+    return np.array([field.TransformPoint(point.tolist()) for point in points])
+
+def compose_jobs(job_folders, output_folder, moving_path=None, result_image_path=None,
+                 interpolator="bspline", fold=True):
+    """Composes the registrations of job folders of Registering_batch.py (in image direction), writes the
+    chain to output_folder and, if moving_path is given, resamples it once into result_image_path.
+    Returns the paths of the written transform parameter files."""
+    os.makedirs(output_folder, exist_ok=True)
+    chain = compose_registrations(*[load_job_chain(folder) for folder in job_folders], fold=fold)
+    transform_files = write_transform_chain(chain, output_folder)
+    if moving_path is not None:
+        sitk.WriteImage(resample(sitk.ReadImage(moving_path), chain, interpolator), result_image_path)
+    return transform_files
+
+if __name__ == "__main__":
+    import sys
+    import time
+    start_time = time.time()
+    arguments = sys.argv[1:]
+    options = {}
+    for flag in ("--moving", "--result"):
+        if flag in arguments:
+            i = arguments.index(flag)
+            options[flag] = arguments[i + 1]
+            del arguments[i:i + 2]
+    files = compose_jobs(arguments[1:], arguments[0], options.get("--moving"), options.get("--result"))
+    print(f"Composed {len(arguments) - 1} registrations into {len(files)} maps in {arguments[0]} "
+          f"in {time.time() - start_time:.2f} seconds")
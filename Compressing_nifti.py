@@ -0,0 +1,110 @@
+""" Compression of converted NIfTI files.
+
+dcm2niix -z y (without pigz installed) and nibabel compress with a single thread, which for large CTA
+volumes is a large share of the conversion time. Here a .nii is compressed with pigz when it is installed,
+otherwise with zlib in parallel threads (one gzip member per chunk; the result is a normal .nii.gz that
+gzip, nibabel and SimpleITK read as usual).
+
+Deferred compression: convert with compression = "deferred" in Converting_dcm_to_nii.py to keep
+uncompressed .nii working copies, then compress them later in the background with
+    nohup python Compressing_nifti.py <NIfTI output folder> &"""
+
+import json
+import os
+import shutil
+import subprocess
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+from Indexing_series import index_name, open_index
+
+compression_level = 6  # 1 = fastest .. 9 = smallest
+num_threads = os.cpu_count() or 1
+chunk_size = 4 * 1024 ** 2  # Bytes compressed per thread and gzip member
+
+# Function to compress one chunk into a complete gzip member
+def _compress_chunk(chunk, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = gzip header and trailer
+    return compressor.compress(chunk) + compressor.flush()
+
+# Function to gzip a file with several threads
+def gzip_file(path, level=compression_level, threads=num_threads):
+    """Compresses path into path.gz and removes path. Returns the path of the compressed file."""
+    output = path + ".gz"
+    pigz = shutil.which("pigz")
+    if pigz is not None and threads > 1:
+        subprocess.run([pigz, f"-{level}", "-p", str(threads), "-f", path], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return output
+
+    # zlib releases the GIL while compressing, so the threads run in parallel.
+    # At most `threads` chunks are read at a time to keep memory bounded.
+    with open(path, "rb") as source, open(output + ".tmp", "wb") as target, \
+            ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+        while True:
+            chunks = [chunk for chunk in (source.read(chunk_size) for _ in range(max(1, threads))) if chunk]
+            if not chunks:
+                break
+            for member in executor.map(_compress_chunk, chunks, repeat(level)):
+                target.write(member)
+    os.replace(output + ".tmp", output)
+    os.remove(path)
+    return output
+
+# Function to compress a NIfTI and measure the tradeoff
+def compress_nifti(path, level=compression_level, threads=num_threads):
+    """Compresses a .nii file and returns the measured sizes and time."""
+    uncompressed_bytes = os.path.getsize(path)
+    start_time = time.perf_counter()
+    output = gzip_file(path, level, threads)
+    seconds = time.perf_counter() - start_time
+    compressed_bytes = os.path.getsize(output)
+    return {
+        "file": os.path.basename(output),
+        "level": level,
+        "threads": threads,
+        "uncompressed_bytes": uncompressed_bytes,
+        "compressed_bytes": compressed_bytes,
+        "ratio": round(compressed_bytes / max(uncompressed_bytes, 1), 4),
+        "seconds": round(seconds, 3),
+        "mb_per_second": round(uncompressed_bytes / 1024 ** 2 / max(seconds, 1e-9), 1),
+    }
+
+# Function to print the tradeoff over many files
+def print_compression_summary(stats):
+    if not stats:
+        return
+    uncompressed = sum(s["uncompressed_bytes"] for s in stats)
+    compressed = sum(s["compressed_bytes"] for s in stats)
+    seconds = sum(s["seconds"] for s in stats)
+    print(f"Compressed {len(stats)} files: {uncompressed / 1024 ** 2:.1f} MB -> {compressed / 1024 ** 2:.1f} MB "
+          f"({100 * compressed / max(uncompressed, 1):.1f}%) in {seconds:.2f} s "
+          f"({uncompressed / 1024 ** 2 / max(seconds, 1e-9):.1f} MB/s)")
+
+# Deferred compression stage
+def compress_pending(output_folder, level=compression_level, threads=num_threads):
+    """Compresses every .nii below output_folder (the working copies left by deferred compression),
+    updates their paths in the series index and appends the measurements to compression_report.jsonl."""
+    pending = []
+    for root, dirs, files in os.walk(output_folder):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]  # skip the work folders of running conversions
+        pending += [os.path.join(root, name) for name in sorted(files) if name.endswith(".nii")]
+    stats = []
+    for path in pending:
+        stats.append(dict(compress_nifti(path, level, threads), series=os.path.relpath(path, output_folder)))
+
+    index_file = os.path.join(output_folder, index_name)
+    if os.path.exists(index_file):
+        with open_index(index_file) as conn:
+            conn.executemany("UPDATE series SET nifti_path = ? WHERE nifti_path = ?",
+                             [(path + ".gz", path) for path in pending])
+    with open(os.path.join(output_folder, "compression_report.jsonl"), "a") as f:
+        for s in stats:
+            f.write(json.dumps(s) + "\n")
+    return stats
+
+if __name__ == "__main__":
+    import sys
+    print_compression_summary(compress_pending(sys.argv[1]))
@@ -1,46 +1,264 @@
-""" Equivalent of this script is the command line 
-sftp://160.85.79.231/data/golubeka/data2024-mock/dcm2niix -z y -f t1_se_tra_4mm_-_13 -o /data/golubeka/EBRAINS/Nifti_T1_images /data/golubeka/EBRAINS/Patient_1712/t1_se_tra_4mm_-_13"""
+""" Equivalent of this script is the command line
+sftp://160.85.79.231/data/golubeka/data2024-mock/dcm2niix -z y -f t1_se_tra_4mm_-_13 -o /data/golubeka/EBRAINS/Nifti_T1_images /data/golubeka/EBRAINS/Patient_1712/t1_se_tra_4mm_-_13
 
+All series below base_path are found from their DICOM headers (see Discovering_dicom_series.py), grouped by
+StudyInstanceUID/SeriesInstanceUID wherever they are stored, and converted into one output folder per patient.
+Series are converted in parallel, one dcm2niix process per worker (or in process with
+backend = "python", see Converting_dcm_to_nii_python.py).
+Series that did not change since the last run (see conversion_manifest.json in the output folder) are skipped.
+Output compression is selectable (see Compressing_nifti.py).
+Every conversion appends a record (files, bytes in and out, wall and CPU time, dcm2niix exit code and warnings,
+compression) to conversion_metrics.jsonl in the output folder; see Summarizing_conversion_metrics.py."""
+
+import glob
+import json
 import os
+import re
+import resource
 import subprocess
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
 import logging
 
+from Compressing_nifti import compress_nifti, print_compression_summary
+from Converting_dcm_to_nii_python import convert_series_in_process
+from Discovering_dicom_series import discover_series, filter_series
+from Indexing_series import index_name, update_index
+
 # Set paths
-base_path = "/data/golubeka/EBRAINS/Patient_1712"  # Replace with the base directory path containing patient folders
+base_path = "/data/golubeka/EBRAINS/DICOM"  # Replace with the base directory path containing patient folders (e.g. Patient_1712)
 output_path = "/data/golubeka/EBRAINS/Nifti_T1_images"  # Replace with the directory where you want to save the NIfTI files
-os.makedirs(output_path, exist_ok=True)
+dcm2niix_path = "/data/golubeka/data2024-mock/dcm2niix"  # Path to dcm2niix executable
+
+manifest_name = "conversion_manifest.json"  # Stored in output_path, remembers what was already converted
+header_cache_name = "dicom_header_cache.json"  # Stored in output_path, avoids reading unchanged DICOM headers again
+metrics_name = "conversion_metrics.jsonl"  # Stored in output_path, one JSON record per converted series
+
+# Suffixes dcm2niix appends to the output name of one series (echoes, phase, real/imaginary, coils, images,
+# ROIs, equalized/tilt-corrected/motion-corrected volumes, ...)
+dcm2niix_suffixes = r"(_(e\d+|ph|real|imaginary|c\d+|i\d+|t\d+|ROI\d+|Eq|Tilt|MoCo|ADC|trace|fieldmaphz))*"
 
-# Configure logging
-logging.basicConfig(filename="conversion_errors.log", level=logging.ERROR, format="%(asctime)s - %(message)s")
+# Conversion backend: "dcm2niix" (subprocess) or "python" (pydicom + nibabel, in process)
+backend = "dcm2niix"
 
-# Time tracking
-start_time = time.time()
+# Series selection from the DICOM headers, applied before conversion (see series_skip_reason in Discovering_dicom_series.py)
+series_filters = {
+    "modalities": ["MR", "CT"],
+    "min_slices": 10,  # localizers, scouts and single images
+    "exclude_image_type": ["LOCALIZER", "DERIVED", "SECONDARY"],  # MIPs, reformats, screen captures
+    "exclude_description": r"(?i)localizer|scout|survey|topogram|\bloc\b|screen ?save|dose ?report",
+}
+
+# Output compression:
+#   "gzip"     - single-threaded gzip by the backend (dcm2niix -z y, as before)
+#   "parallel" - write .nii, then gzip it with compression_threads threads (pigz if installed)
+#   "deferred" - keep .nii working copies, compress them later with Compressing_nifti.py
+compression = "gzip"
+compression_level = 6  # 1 = fastest .. 9 = smallest
+compression_threads = None  # None: the cores divided among the series converted at the same time
+
+# Number of series converted at the same time (1 = sequential, as before)
+num_workers = os.cpu_count() or 1
 
 # Function to convert DICOM to NIfTI
-def convert_dicom_to_nifti(input_folder, output_folder, output_name):
-    """Converts DICOM files in the specified folder to NIfTI using dcm2niix, retaining the original name."""
+def convert_dicom_to_nifti(input_folder, output_folder, output_name, gzip_output=True):
+    """Converts DICOM files in the specified folder to NIfTI using dcm2niix, retaining the original name.
+
+    Returns a dict with the error message (None on success), the dcm2niix exit code and its warnings.
+    """
+    result = {"error": None, "exit_code": None, "warnings": []}
     try:
         # Command to execute dcm2niix
         command = [
-            "/data/golubeka/data2024-mock/dcm2niix",  # Path to dcm2niix executable
-            "-z", "y",                    # Enable compression (output .nii.gz)
+            dcm2niix_path,                # Path to dcm2niix executable
+            "-z", "y" if gzip_output else "n",  # Compression (output .nii.gz) or plain .nii
+            f"-{compression_level}",      # gz compression level
             "-f", output_name,            # Output filename, based on original DICOM folder name
             "-o", output_folder,          # Output directory
             input_folder                  # Input DICOM directory
         ]
-        subprocess.run(command, check=True)
+        # dcm2niix output is captured, otherwise the parallel workers print over the progress bar
+        completed = subprocess.run(command, check=True, capture_output=True, text=True, errors="replace")
+        result["exit_code"] = completed.returncode
     except subprocess.CalledProcessError as e:
-        logging.error(f"Failed to convert {input_folder} to NIfTI: {e}")
-
-# Process each DICOM folder in the base path
-for dicom_folder in tqdm(os.listdir(base_path), desc="Converting DICOM to NIfTI"):
-    dicom_path = os.path.join(base_path, dicom_folder)
-    if os.path.isdir(dicom_path):
-        # Use the folder name as the output NIfTI file name to retain the original naming
-        convert_dicom_to_nifti(dicom_path, output_path, dicom_folder)
-
-# Print total processing time
-end_time = time.time()
-print(f"Total processing time: {end_time - start_time:.2f} seconds")
+        completed = e
+        result["exit_code"] = e.returncode
+        result["error"] = f"Failed to convert {input_folder} to NIfTI: {e}"
+    except OSError as e:
+        result["error"] = f"Failed to convert {input_folder} to NIfTI: {e}"
+        return result
+    result["warnings"] = [line.strip() for line in f"{completed.stdout}\n{completed.stderr}".splitlines()
+                          if "warning" in line.lower()]
+    return result
+
+# Function to convert one series, whose files may be spread over several folders
+def _convert_files(files, output_folder, output_name, backend, gzip_output):
+    """Converts the given DICOM files to one NIfTI with the given backend.
+
+    If the files are exactly the content of one folder, that folder is given to dcm2niix. Otherwise the
+    files are linked into a temporary folder first, so that dcm2niix only sees this series.
+    """
+    if backend == "python":
+        error = convert_series_in_process(files, output_folder, output_name, compress=gzip_output)
+        return {"error": error, "exit_code": None, "warnings": []}
+    folders = {os.path.dirname(path) for path in files}
+    if len(folders) == 1:
+        folder = folders.pop()
+        if len(os.listdir(folder)) == len(files):
+            return convert_dicom_to_nifti(folder, output_folder, output_name, gzip_output)
+    with tempfile.TemporaryDirectory(prefix="series_") as staging_folder:
+        for i, path in enumerate(files):
+            os.symlink(os.path.abspath(path), os.path.join(staging_folder, f"{i:06d}.dcm"))
+        return convert_dicom_to_nifti(staging_folder, output_folder, output_name, gzip_output)
+
+def convert_series(files, output_folder, output_name, backend=backend, compression=compression,
+                   threads=compression_threads):
+    """Converts one series and compresses its output according to `compression`, with `threads` threads in
+    "parallel" mode (all cores if None; convert_all gives every series its share).
+
+    Returns the metrics record of the series: error message (None on success), number of files,
+    input and output bytes, wall and CPU time (including dcm2niix and pigz), dcm2niix exit code and
+    warnings, and the compression measurements.
+    """
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    os.makedirs(output_folder, exist_ok=True)
+    record = {"output_name": output_name, "backend": backend, "n_files": len(files),
+              "input_bytes": sum(os.path.getsize(path) for path in files), "output_bytes": 0, "compression": []}
+
+    # Compress here instead of in the backend: in parallel, or with the configured level for nibabel
+    compress_here = compression == "parallel" or (compression == "gzip" and backend == "python")
+
+    # Convert into a private work folder, so that every file in it belongs to this series
+    with tempfile.TemporaryDirectory(prefix=".converting_", dir=output_folder) as work_folder:
+        record.update(_convert_files(files, work_folder, output_name, backend, compression == "gzip" and not compress_here))
+        if record["error"] is None:
+            threads = (threads or os.cpu_count() or 1) if compression == "parallel" else 1
+            try:
+                if compress_here:
+                    for name in sorted(os.listdir(work_folder)):
+                        if name.endswith(".nii"):
+                            record["compression"].append(compress_nifti(os.path.join(work_folder, name), compression_level, threads))
+                for name in os.listdir(work_folder):
+                    record["output_bytes"] += os.path.getsize(os.path.join(work_folder, name))
+                    os.replace(os.path.join(work_folder, name), os.path.join(output_folder, name))
+            except (OSError, subprocess.CalledProcessError) as e:
+                record["error"] = f"Failed to compress {output_name}: {e}"
+
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record["wall_seconds"] = round(time.perf_counter() - start_wall, 3)
+    record["cpu_seconds"] = round(time.process_time() - start_cpu
+                                  + (end_children.ru_utime - start_children.ru_utime)
+                                  + (end_children.ru_stime - start_children.ru_stime), 3)
+    record["finished_at"] = time.time()
+    return record
+
+# Functions for the conversion manifest
+def load_manifest(output_folder):
+    """Loads the manifest of already converted series, or an empty one."""
+    manifest_file = os.path.join(output_folder, manifest_name)
+    if not os.path.exists(manifest_file):
+        return {}
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Ignoring unreadable manifest {manifest_file}: {e}")
+        return {}
+
+def save_manifest(output_folder, manifest):
+    """Writes the manifest atomically, so an interrupted run never leaves a broken file behind."""
+    manifest_file = os.path.join(output_folder, manifest_name)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+def _is_output_of(file_name, output_name):
+    """True if file_name is a NIfTI written for output_name: the name itself or with dcm2niix suffixes,
+    not another series whose name starts with output_name (T1_post.nii.gz is not an output of T1)."""
+    return re.fullmatch(re.escape(output_name) + dcm2niix_suffixes + r"\.nii(\.gz)?", file_name) is not None
+
+def is_up_to_date(manifest, series_key, output_folder, output_name, signature):
+    """True if the series was converted before from exactly the same files and its output still exists."""
+    return (manifest.get(series_key) == signature
+            and any(_is_output_of(os.path.basename(path), output_name)
+                    for path in glob.glob(os.path.join(output_folder, glob.escape(output_name) + "*.nii*"))))
+
+# Function to convert all series with a bounded pool of workers
+def convert_all(jobs, workers=num_workers, backend=backend, compression=compression):
+    """Converts every (series_key, files, output_folder, output_name) job, running at most `workers`
+    dcm2niix processes at once.
+
+    Errors are collected in the parent process and written to conversion_errors.log.
+    Returns the record of every series (see convert_series), with its series key.
+    """
+    records = []
+    # one share of the cores per series, so that parallel compression does not start cores * workers threads
+    threads = compression_threads or max(1, (os.cpu_count() or 1) // max(1, workers))
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(convert_series, files, output_folder, output_name, backend, compression, threads): series_key
+                   for series_key, files, output_folder, output_name in jobs}
+        with tqdm(total=len(futures), desc="Converting DICOM to NIfTI") as pbar:
+            for future in as_completed(futures):
+                try:
+                    record = dict(future.result(), series=futures[future])
+                except Exception as e:
+                    record = {"series": futures[future], "error": f"Failed to convert {futures[future]}: {e}", "compression": []}
+                if record["error"] is not None:
+                    logging.error(record["error"])
+                records.append(record)
+                pbar.update(1)
+    return records
+
+if __name__ == "__main__":
+    os.makedirs(output_path, exist_ok=True)
+
+    # Configure logging
+    logging.basicConfig(filename="conversion_errors.log", level=logging.ERROR, format="%(asctime)s - %(message)s")
+
+    # Time tracking
+    start_time = time.time()
+
+    # Find every series of every patient from the DICOM headers
+    series = discover_series(base_path, cache_file=os.path.join(output_path, header_cache_name), exclude=[output_path])
+
+    # Leave out the series we never use (localizers, derived series, ...) before converting anything
+    series, skipped = filter_series(series, series_filters)
+    print(f"{len(series)} series selected, {len(skipped)} left out by series_filters")
+    jobs = [(series_key, entry["files"], os.path.join(output_path, entry["patient"]), entry["output_name"])
+            for series_key, entry in sorted(series.items())]
+
+    # Skip the series that did not change since they were last converted
+    manifest = load_manifest(output_path)
+    to_convert = [job for job in jobs
+                  if not is_up_to_date(manifest, job[0], job[2], job[3], series[job[0]]["signature"])]
+    print(f"{len(jobs) - len(to_convert)} series up to date, {len(to_convert)} to convert")
+
+    records = convert_all(to_convert)
+    failures = {record["series"] for record in records if record["error"] is not None}
+    for series_key, _, _, _ in to_convert:
+        if series_key in failures:
+            manifest.pop(series_key, None)
+        else:
+            manifest[series_key] = series[series_key]["signature"]
+    save_manifest(output_path, manifest)
+
+    # Record every converted series in the SQLite series index (see Indexing_series.py)
+    update_index(os.path.join(output_path, index_name),
+                 {series_key: entry for series_key, entry in series.items() if series_key not in failures}, output_path)
+    if failures:
+        print(f"{len(failures)} of {len(to_convert)} series failed, see conversion_errors.log")
+
+    # Append the per-series metrics of this run (see Summarizing_conversion_metrics.py)
+    with open(os.path.join(output_path, metrics_name), "a") as f:
+        for record in records:
+            f.write(json.dumps(dict(record, run=start_time)) + "\n")
+    print_compression_summary([stats for record in records for stats in record["compression"]])
+
+    # Print total processing time
+    end_time = time.time()
+    print(f"Total processing time: {end_time - start_time:.2f} seconds")
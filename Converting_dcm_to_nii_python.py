@@ -0,0 +1,114 @@
+""" In-process DICOM to NIfTI conversion with pydicom and nibabel (no dcm2niix subprocess).
+
+Slices are sorted along the slice normal by ImagePositionPatient and stacked into a preallocated array
+(a np.memmap on disk for very large series). The affine is computed from ImageOrientationPatient,
+ImagePositionPatient and PixelSpacing and converted from DICOM LPS to NIfTI RAS.
+Only single-frame, single-volume series are handled; anything else raises a ValueError so that
+dcm2niix can be used instead."""
+
+import os
+import tempfile
+
+import nibabel as nib
+import numpy as np
+import pydicom
+
+# Series larger than this are stacked into a memory-mapped temporary file instead of RAM
+memmap_threshold_bytes = 2 * 1024 ** 3
+
+# Function to read the geometry of every slice
+def _slice_geometry(headers):
+    """Returns the slices sorted along the slice normal, with the row/column directions and positions."""
+    orientation = np.array(headers[0].ImageOrientationPatient, dtype=float)
+    row_direction, column_direction = orientation[:3], orientation[3:]
+    normal = np.cross(row_direction, column_direction)
+    for ds in headers:
+        if not np.allclose(np.array(ds.ImageOrientationPatient, dtype=float), orientation, atol=1e-4):
+            raise ValueError("Slices have different orientations")
+        if (ds.Rows, ds.Columns) != (headers[0].Rows, headers[0].Columns):
+            raise ValueError("Slices have different sizes")
+        if int(ds.get("NumberOfFrames", 1) or 1) > 1:
+            raise ValueError("Multi-frame DICOM is not supported by the python backend")
+
+    positions = np.array([ds.ImagePositionPatient for ds in headers], dtype=float)
+    distances = positions @ normal
+    order = np.argsort(distances, kind="stable")
+    if len(order) > 1 and np.min(np.diff(distances[order])) < 1e-3:
+        raise ValueError("Several slices at the same position (multi-echo or 4D series)")
+    return order, row_direction, column_direction, positions[order]
+
+# Function to compute the NIfTI affine
+def dicom_affine(first_header, row_direction, column_direction, positions):
+    """Returns the 4x4 RAS affine of the volume data[column, row, slice]."""
+    row_spacing, column_spacing = (float(v) for v in first_header.PixelSpacing)
+    if len(positions) > 1:
+        slice_step = (positions[-1] - positions[0]) / (len(positions) - 1)
+    else:
+        thickness = float(first_header.get("SpacingBetweenSlices", first_header.get("SliceThickness", 1.0)))
+        slice_step = np.cross(row_direction, column_direction) * thickness
+
+    affine = np.eye(4)
+    affine[:3, 0] = row_direction * column_spacing  # first array axis runs along a row (columns)
+    affine[:3, 1] = column_direction * row_spacing  # second array axis runs along a column (rows)
+    affine[:3, 2] = slice_step
+    affine[:3, 3] = positions[0]
+    # DICOM patient coordinates are LPS, NIfTI world coordinates are RAS
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+
+# Function to stack the slices of one series
+def read_series(files, memmap_folder=None):
+    """Reads a series into (data, affine, slope, intercept).
+
+    data has shape (columns, rows, slices) and keeps the stored dtype when every slice has the same
+    rescale slope and intercept (they are returned to go into the NIfTI header). Otherwise the
+    rescaled values are stored as float32 and slope/intercept are (1, 0).
+    """
+    headers = [pydicom.dcmread(path, stop_before_pixels=True) for path in files]
+    order, row_direction, column_direction, positions = _slice_geometry(headers)
+    affine = dicom_affine(headers[order[0]], row_direction, column_direction, positions)
+
+    scaling = {(float(ds.get("RescaleSlope", 1) or 1), float(ds.get("RescaleIntercept", 0) or 0)) for ds in headers}
+    first = pydicom.dcmread(files[order[0]]).pixel_array
+    dtype = first.dtype if len(scaling) == 1 else np.float32
+    shape = (first.shape[1], first.shape[0], len(files))
+
+    # Preallocate the volume, on disk if it does not comfortably fit in memory
+    nbytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+    if nbytes > memmap_threshold_bytes:
+        with tempfile.NamedTemporaryFile(dir=memmap_folder, suffix=".dat", delete=False) as memmap_file:
+            pass
+        data = np.memmap(memmap_file.name, dtype=dtype, mode="w+", shape=shape)
+    else:
+        data = np.empty(shape, dtype=dtype)
+
+    for k, index in enumerate(order):
+        pixels = first if k == 0 else pydicom.dcmread(files[index]).pixel_array
+        if len(scaling) > 1:
+            ds = headers[index]
+            pixels = pixels * float(ds.get("RescaleSlope", 1) or 1) + float(ds.get("RescaleIntercept", 0) or 0)
+        data[:, :, k] = pixels.T
+
+    slope, intercept = scaling.pop() if len(scaling) == 1 else (1.0, 0.0)
+    return data, affine, slope, intercept
+
+# Function with the same contract as convert_dicom_to_nifti in Converting_dcm_to_nii.py
+def convert_series_in_process(files, output_folder, output_name, compress=True):
+    """Converts the given DICOM files to output_folder/output_name.nii.gz without starting dcm2niix.
+
+    Returns None on success, or the error message so that the caller can log it.
+    """
+    data = None
+    try:
+        data, affine, slope, intercept = read_series(sorted(files), memmap_folder=output_folder)
+        image = nib.Nifti1Image(data, affine)
+        image.header.set_slope_inter(slope, intercept)
+        image.set_qform(affine, code=1)  # scanner coordinates
+        image.set_sform(affine, code=1)
+        image.header.set_xyzt_units("mm")
+        nib.save(image, os.path.join(output_folder, output_name + (".nii.gz" if compress else ".nii")))
+    except Exception as e:
+        return f"Failed to convert {output_name} to NIfTI in process: {e}"
+    finally:
+        if isinstance(data, np.memmap):
+            os.remove(data.filename)
+    return None
@@ -0,0 +1,212 @@
+""" Finds every DICOM series below an archive folder, wherever its files are stored.
+
+Only the headers are read (pydicom with stop_before_pixels, in parallel threads) and files are grouped
+by StudyInstanceUID and SeriesInstanceUID. Headers of files that did not change since the previous run
+are taken from a JSON cache, so rediscovering a large archive costs one stat per file.
+filter_series() applies include/exclude rules on header fields, so unused series are never converted."""
+
+import json
+import logging
+import os
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+from pydicom.multival import MultiValue
+from tqdm import tqdm
+
+# Header fields read for every file (pixel data is never read)
+header_fields = ["PatientID", "StudyInstanceUID", "SeriesInstanceUID", "SeriesNumber",
+                 "SeriesDescription", "Modality", "ImageType", "FrameOfReferenceUID",
+                 "Rows", "Columns", "PixelSpacing", "SliceThickness", "SpacingBetweenSlices", "NumberOfFrames"]
+
+# Number of threads reading headers at the same time (discovery is I/O bound)
+num_threads = 32
+
+# Function to turn pydicom values into plain JSON values
+def _to_plain(value):
+    if isinstance(value, (list, tuple, MultiValue)):
+        return [_to_plain(v) for v in value]
+    # IS, DSfloat and UID are subclasses of int, float and str
+    for plain in (int, float, str):
+        if isinstance(value, plain):
+            return plain(value)
+    return str(value)
+
+# Function to read the header of one file
+def read_header(path):
+    """Returns the header fields of a DICOM file as a dict, or None if the file is not a DICOM image."""
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=header_fields)
+    except (InvalidDicomError, OSError, ValueError):
+        return None
+    if "SeriesInstanceUID" not in ds:
+        return None  # DICOMDIR, structured reports without series, ...
+    return {field: _to_plain(ds.get(field)) for field in header_fields if ds.get(field) is not None}
+
+# Function to list every file of the archive with its size and mtime
+def list_files(archive_path, exclude=()):
+    """Walks the archive and yields (path, size, mtime) for every regular file, skipping the `exclude` folders."""
+    exclude = {os.path.abspath(path) for path in exclude}
+    for root, dirs, files in os.walk(archive_path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith(".") and os.path.abspath(os.path.join(root, d)) not in exclude)
+        for name in sorted(files):
+            if name.startswith(".") or name == "DICOMDIR":
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield path, stat.st_size, stat.st_mtime
+
+# Functions for the header cache
+def load_header_cache(cache_file):
+    """Loads the header cache, or returns an empty one if it is missing or was built for other header fields."""
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Ignoring unreadable header cache {cache_file}: {e}")
+        return {}
+    if cache.get("header_fields") != header_fields:
+        return {}
+    return cache.get("files", {})
+
+def save_header_cache(cache_file, cache):
+    with open(cache_file + ".tmp", "w") as f:
+        json.dump({"header_fields": header_fields, "files": cache}, f)
+    os.replace(cache_file + ".tmp", cache_file)
+
+# Function to give a series a file name
+def _safe_name(text):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text).strip("_") or "series"
+
+def series_output_name(series, folder_series_count):
+    """Uses the folder name if the series is alone in one folder (the naming used so far),
+    otherwise SeriesDescription_-_SeriesNumber."""
+    folders = {os.path.dirname(path) for path in series["files"]}
+    if len(folders) == 1:
+        folder = folders.pop()
+        if folder_series_count[folder] == 1:
+            return os.path.basename(folder)
+    description = _safe_name(str(series.get("SeriesDescription", "series")))
+    return f"{description}_-_{series.get('SeriesNumber', 0)}"
+
+# Main discovery function
+def discover_series(archive_path, cache_file=None, exclude=(), threads=num_threads):
+    """Groups all DICOM files below archive_path by (StudyInstanceUID, SeriesInstanceUID).
+
+    Returns a dict "StudyInstanceUID/SeriesInstanceUID" -> series, where a series holds the header fields,
+    the patient folder (first folder below archive_path), the output name, the sorted file list, the number of
+    slices (n_slices: the frames of multi-frame files, one per classic file) and its signature (file count,
+    total size, newest mtime).
+    """
+    cache = load_header_cache(cache_file)
+    files = list(list_files(archive_path, exclude))
+    to_read = [path for path, size, mtime in files
+               if path not in cache or cache[path][:2] != [size, mtime]]
+
+    # Read the headers of new or changed files in parallel threads
+    if to_read:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            headers = list(tqdm(executor.map(read_header, to_read), total=len(to_read), desc="Reading DICOM headers"))
+        stats = {path: (size, mtime) for path, size, mtime in files}
+        for path, header in zip(to_read, headers):
+            cache[path] = [*stats[path], header]
+
+    # Drop files that disappeared from the archive, then save the cache
+    present = {path for path, _, _ in files}
+    cache = {path: entry for path, entry in cache.items() if path in present}
+    if cache_file is not None:
+        save_header_cache(cache_file, cache)
+
+    # Group files by series
+    series = {}
+    for path, size, mtime in files:
+        header = cache[path][2]
+        if header is None:
+            continue
+        key = f"{header.get('StudyInstanceUID', '')}/{header['SeriesInstanceUID']}"
+        if key not in series:
+            relative = os.path.relpath(path, archive_path).split(os.sep)
+            series[key] = dict(header, patient=relative[0] if len(relative) > 1 else "unknown", files=[], n_slices=0,
+                               signature={"n_files": 0, "total_size": 0, "newest_mtime": 0.0})
+        entry = series[key]
+        entry["files"].append(path)
+        # an enhanced multi-frame file (Philips 3D TFE, TOF) holds all slices of the series
+        entry["n_slices"] += max(1, int(header.get("NumberOfFrames") or 1))
+        entry["signature"]["n_files"] += 1
+        entry["signature"]["total_size"] += size
+        entry["signature"]["newest_mtime"] = max(entry["signature"]["newest_mtime"], mtime)
+
+    # Name every series
+    folder_series = defaultdict(set)
+    for key, entry in series.items():
+        for path in entry["files"]:
+            folder_series[os.path.dirname(path)].add(key)
+    folder_series_count = {folder: len(keys) for folder, keys in folder_series.items()}
+    for entry in series.values():
+        entry["files"].sort()
+        entry["output_name"] = series_output_name(entry, folder_series_count)
+
+    # Two series of one patient may share a name (same description and number in two studies)
+    seen = defaultdict(int)
+    for key in sorted(series):
+        entry = series[key]
+        name = (entry["patient"], entry["output_name"])
+        seen[name] += 1
+        if seen[name] > 1:
+            entry["output_name"] = f"{entry['output_name']}_{seen[name]}"
+    return series
+
+# Function to select series from their headers only
+def series_skip_reason(entry, rules):
+    """Returns why a series is excluded by the rules, or None if it is kept.
+
+    rules is a dict with any of:
+        "modalities": list of Modality values to keep
+        "min_slices", "max_slices": bounds on the number of slices of the series (files, or frames of
+                                    multi-frame files)
+        "exclude_image_type": ImageType values (e.g. "LOCALIZER", "DERIVED") that exclude a series
+        "include_description", "exclude_description": regular expressions on SeriesDescription
+    """
+    description = str(entry.get("SeriesDescription", ""))
+    image_type = entry.get("ImageType") or []
+    image_type = [image_type] if isinstance(image_type, str) else image_type
+    n_slices = entry.get("n_slices", len(entry["files"]))
+    if rules.get("modalities") and entry.get("Modality") not in rules["modalities"]:
+        return f"modality {entry.get('Modality')}"
+    if n_slices < rules.get("min_slices", 0):
+        return f"{n_slices} slices"
+    if rules.get("max_slices") is not None and n_slices > rules["max_slices"]:
+        return f"{n_slices} slices"
+    excluded_types = set(rules.get("exclude_image_type", [])) & {str(value).upper() for value in image_type}
+    if excluded_types:
+        return f"ImageType {'/'.join(sorted(excluded_types))}"
+    if rules.get("include_description") and not re.search(rules["include_description"], description):
+        return "description not included"
+    if rules.get("exclude_description") and re.search(rules["exclude_description"], description):
+        return "description excluded"
+    return None
+
+def filter_series(series, rules):
+    """Splits discovered series into (kept, skipped) dicts; skipped maps each series key to its reason."""
+    kept, skipped = {}, {}
+    for key, entry in series.items():
+        reason = series_skip_reason(entry, rules)
+        if reason is None:
+            kept[key] = entry
+        else:
+            skipped[key] = reason
+    return kept, skipped
+
+if __name__ == "__main__":
+    import sys
+    found = discover_series(sys.argv[1])
+    for key, entry in sorted(found.items(), key=lambda item: (item[1]["patient"], item[1]["output_name"])):
+        print(f"{entry['patient']}\t{entry['output_name']}\t{entry.get('Modality', '')}\t{len(entry['files'])} files")
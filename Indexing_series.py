@@ -0,0 +1,146 @@
+""" SQLite index of the converted series, so that scripts select their inputs by query instead of file names.
+
+One row per series: patient, modality, SeriesDescription, voxel size, matrix, FrameOfReferenceUID, the
+output NIfTI path and a role ("tof", "t1_3d", "t1", "cta", ...) derived from the header when indexing.
+Converting_dcm_to_nii.py updates the index after every run; it can also be rebuilt from the header cache:
+    python Indexing_series.py <DICOM archive> <NIfTI output folder>
+
+Example:
+    with open_index('/data/golubeka/EBRAINS/Nifti_T1_images/series_index.sqlite') as conn:
+        for patient, tof, t1 in pairs_per_patient(conn, "tof", "t1_3d"):
+            print(patient, tof["nifti_path"], t1["nifti_path"])"""
+
+import glob
+import os
+import re
+import sqlite3
+from contextlib import closing, contextmanager
+
+index_name = "series_index.sqlite"  # Stored in the NIfTI output folder
+
+# Roles, checked in order: (role, modality, SeriesDescription regex)
+roles = [
+    ("localizer", None, r"(?i)localizer|scout|survey|topogram|\bloc\b"),
+    ("tof", "MR", r"(?i)\btof\b|tof[-_ ]|willis|\bmra\b|angio"),
+    ("t1_3d", "MR", r"(?i)t1.*(3d|tfe|mprage|spgr|bravo)|(3d|tfe|mprage|spgr|bravo).*t1"),
+    ("t1", "MR", r"(?i)t1"),
+    ("t2", "MR", r"(?i)t2|flair"),
+    ("cta", "CT", r"(?i)angio|\bcta\b"),
+    ("ct", "CT", r""),
+]
+
+columns = ["series_key", "patient", "patient_id", "study_uid", "series_uid", "series_number", "modality",
+           "series_description", "role", "voxel_x", "voxel_y", "voxel_z", "matrix_x", "matrix_y", "matrix_z",
+           "frame_of_reference_uid", "nifti_path"]
+
+schema = """
+CREATE TABLE IF NOT EXISTS series (
+    series_key TEXT PRIMARY KEY,
+    patient TEXT, patient_id TEXT, study_uid TEXT, series_uid TEXT, series_number INTEGER,
+    modality TEXT, series_description TEXT, role TEXT,
+    voxel_x REAL, voxel_y REAL, voxel_z REAL,
+    matrix_x INTEGER, matrix_y INTEGER, matrix_z INTEGER,
+    frame_of_reference_uid TEXT, nifti_path TEXT
+);
+CREATE INDEX IF NOT EXISTS series_role ON series (role, patient);
+CREATE INDEX IF NOT EXISTS series_patient ON series (patient, modality);
+"""
+
+# Function to assign a role to a series from its header
+def classify_series(entry):
+    modality = entry.get("Modality", "")
+    description = str(entry.get("SeriesDescription", ""))
+    for role, role_modality, pattern in roles:
+        if role_modality in (None, modality) and re.search(pattern, description):
+            return role
+    return modality.lower() or "unknown"
+
+# Function to find the NIfTI written for a series
+def nifti_output(output_folder, output_name):
+    """Returns output_name.nii.gz (or .nii) in output_folder, or the first file dcm2niix wrote for it, or None."""
+    for extension in (".nii.gz", ".nii"):
+        path = os.path.join(output_folder, output_name + extension)
+        if os.path.exists(path):
+            return path
+    matches = sorted(glob.glob(os.path.join(output_folder, glob.escape(output_name) + "*.nii*")))
+    return matches[0] if matches else None
+
+# Function to turn one discovered series into an index row
+def series_row(series_key, entry, output_path):
+    pixel_spacing = entry.get("PixelSpacing") or [None, None]
+    slice_spacing = entry.get("SpacingBetweenSlices", entry.get("SliceThickness"))
+    return {
+        "series_key": series_key,
+        "patient": entry["patient"],
+        "patient_id": entry.get("PatientID"),
+        "study_uid": entry.get("StudyInstanceUID"),
+        "series_uid": entry.get("SeriesInstanceUID"),
+        "series_number": entry.get("SeriesNumber"),
+        "modality": entry.get("Modality"),
+        "series_description": entry.get("SeriesDescription"),
+        "role": classify_series(entry),
+        # PixelSpacing is (row spacing, column spacing); x runs along a row
+        "voxel_x": pixel_spacing[1],
+        "voxel_y": pixel_spacing[0],
+        "voxel_z": slice_spacing,
+        "matrix_x": entry.get("Columns"),
+        "matrix_y": entry.get("Rows"),
+        "matrix_z": entry.get("n_slices", len(entry["files"])),
+        "frame_of_reference_uid": entry.get("FrameOfReferenceUID"),
+        "nifti_path": nifti_output(os.path.join(output_path, entry["patient"]), entry["output_name"]),
+    }
+
+# Functions to open and update the index
+@contextmanager
+def open_index(index_file):
+    """Opens (and creates if needed) the index; rows are returned as sqlite3.Row (usable like dicts)."""
+    with closing(sqlite3.connect(index_file)) as conn:
+        conn.row_factory = sqlite3.Row
+        conn.executescript(schema)
+        with conn:
+            yield conn
+
+def update_index(index_file, series, output_path):
+    """Inserts or replaces one row per series (as returned by discover_series) in a single transaction."""
+    rows = [series_row(series_key, entry, output_path) for series_key, entry in series.items()]
+    with open_index(index_file) as conn:
+        conn.executemany(f"INSERT OR REPLACE INTO series ({', '.join(columns)}) "
+                         f"VALUES ({', '.join(':' + c for c in columns)})", rows)
+    return len(rows)
+
+# Query API
+def find_series(conn, role=None, patient=None, converted_only=True):
+    """Returns the series of a role and/or patient, largest matrix first."""
+    conditions, parameters = [], []
+    if role is not None:
+        conditions.append("role = ?")
+        parameters.append(role)
+    if patient is not None:
+        conditions.append("patient = ?")
+        parameters.append(patient)
+    if converted_only:
+        conditions.append("nifti_path IS NOT NULL")
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return conn.execute(f"SELECT * FROM series {where} "
+                        f"ORDER BY patient, matrix_x * matrix_y * matrix_z DESC, series_number", parameters).fetchall()
+
+def pairs_per_patient(conn, role_a, role_b):
+    """Returns (patient, series_a, series_b) for every patient that has both roles,
+    e.g. pairs_per_patient(conn, "tof", "t1_3d") for "the TOF and the 3D T1 of each patient".
+    When a patient has several series of a role, the one with the largest matrix is used."""
+    best = {}
+    for role in (role_a, role_b):
+        for row in find_series(conn, role=role):
+            best.setdefault((role, row["patient"]), row)
+    return [(patient, best[(role_a, patient)], best[(role_b, patient)])
+            for (role, patient) in sorted(best) if role == role_a and (role_b, patient) in best]
+
+if __name__ == "__main__":
+    import sys
+    from Discovering_dicom_series import discover_series
+
+    archive_path, output_path = sys.argv[1], sys.argv[2]
+    series = discover_series(archive_path, cache_file=os.path.join(output_path, "dicom_header_cache.json"),
+                             exclude=[output_path])
+    n_rows = update_index(os.path.join(output_path, index_name), series, output_path)
+    print(f"Indexed {n_rows} series in {os.path.join(output_path, index_name)}")
@@ -0,0 +1,212 @@
+""" Brain masking and cropping of CTA volumes before registration.
+
+The CTA is multiplied by its brain mask and cropped to the bounding box of the mask plus a margin,
+so that neck, air and the rest of the scanner field of view are not written to disk nor given to elastix.
+The affine of the cropped image is shifted to the first kept voxel, so world coordinates do not change.
+
+Both images are read slab by slab through nibabel's dataobj proxy and the output is written slab by slab
+in the stored dtype of the CTA (int16, or the stored dtype plus scl_slope/scl_inter), so peak memory
+depends on the slab size and not on the number of slices.
+
+Run as a script, every CTA in cta_folder is paired with its mask and masked and cropped in a process pool:
+    python Masking_CTA.py
+CTAs without a TotalSegmentator mask get a mask from Skull_stripping_CTA.py when use_builtin_masks is set."""
+
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import nibabel as nib
+import numpy as np
+from tqdm import tqdm
+
+from Compressing_nifti import gzip_file
+from Skull_stripping_CTA import skull_strip_file
+
+# Paths of the batch stage
+cta_folder = '/data/golubeka/data2024-mock/Processed_v1_nifti/CT_converted'
+brain_mask_folder = '/data/golubeka/data2024-mock/Processed_v1_nifti/CT_converted_brain'  # <name>_brain_seg.nii.gz/brain.nii.gz
+output_folder = '/data/golubeka/data2024-mock/Processed_v1_nifti/CT_converted_brain_cropped'
+builtin_mask_folder = '/data/golubeka/data2024-mock/Processed_v1_nifti/CT_converted_brain_fast'  # <name>_brain.nii.gz
+
+# Compute the missing brain masks with the built-in skull stripping instead of only reporting them
+use_builtin_masks = True
+
+# Number of CTAs masked at the same time
+num_workers = os.cpu_count() or 1
+
+# Margin kept around the brain mask, in mm
+crop_margin_mm = 5.0
+
+# Number of slices read and written at a time
+slab_size = 32
+
+# Functions to find the bounding box of a mask
+def _axis_range(projection, zoom, margin_mm):
+    """(start, stop) of the True entries of a 1D projection of the mask, grown by margin_mm."""
+    nonzero = np.flatnonzero(projection)
+    if nonzero.size == 0:
+        raise ValueError("The brain mask is empty")
+    margin = int(math.ceil(margin_mm / float(zoom)))
+    return max(0, int(nonzero[0]) - margin), min(len(projection), int(nonzero[-1]) + 1 + margin)
+
+def mask_bounding_box_slabs(mask_img, margin_mm=crop_margin_mm, slab=slab_size):
+    """Returns the (start, stop) voxel indices per axis of the non-zero voxels of the mask, grown by margin_mm,
+    reading the mask slab by slab along the last axis."""
+    shape = mask_img.shape[:3]
+    projections = [np.zeros(shape[0], bool), np.zeros(shape[1], bool), np.zeros(shape[2], bool)]
+    for z0 in range(0, shape[2], slab):
+        mask_slab = np.asanyarray(mask_img.dataobj[:, :, z0:z0 + slab]) > 0
+        mask_slab = mask_slab.reshape(mask_slab.shape[:3] + (-1,)).any(axis=3)  # 4D masks: any volume
+        projections[0] |= mask_slab.any(axis=(1, 2))
+        projections[1] |= mask_slab.any(axis=(0, 2))
+        projections[2][z0:z0 + slab] = mask_slab.any(axis=(0, 1))
+    zooms = mask_img.header.get_zooms()
+    return [_axis_range(projection, zooms[axis], margin_mm) for axis, projection in enumerate(projections)]
+
+# Function to move the affine to the first voxel of the box
+def cropped_affine(affine, box):
+    """Affine of the image cropped to box: voxel (0, 0, 0) of the crop is voxel box[:][0] of the original."""
+    shift = np.eye(4)
+    shift[:3, 3] = [start for start, _ in box]
+    return affine @ shift
+
+# Function to mask and crop one CTA
+def mask_and_crop(cta_path, brain_mask_path, output_path, margin_mm=crop_margin_mm, slab=slab_size):
+    """Keeps only the brain voxels of the CTA, crops it to the mask bounding box and saves it.
+    Returns the bounding box."""
+    # keep_file_open: slabs are read in order from one open (gzip) file instead of decompressing from the start each time
+    cta_img = nib.load(cta_path, keep_file_open=True)
+    brain_mask_img = nib.load(brain_mask_path, keep_file_open=True)
+    if cta_img.shape[:3] != brain_mask_img.shape[:3] or not np.allclose(cta_img.affine, brain_mask_img.affine, atol=1e-3):
+        raise ValueError(f"{brain_mask_path} is not on the grid of {cta_path}")
+
+    box = mask_bounding_box_slabs(brain_mask_img, margin_mm, slab)
+    (x0, x1), (y0, y1), (z0, z1) = box
+    affine = cropped_affine(cta_img.affine, box)
+
+    # Header of the output: same stored dtype and scaling as the CTA, cropped shape and affine
+    header = cta_img.header.copy()
+    header.set_data_shape((x1 - x0, y1 - y0, z1 - z0))
+    header.set_sform(affine, code=int(cta_img.header["sform_code"]) or 1)
+    header.set_qform(affine, code=int(cta_img.header["qform_code"]) or 1)
+    header["vox_offset"] = 0  # recomputed by write_to
+    dtype = header.get_data_dtype()
+    # nibabel moves scl_slope/scl_inter from the loaded header to the data proxy
+    slope, intercept = float(cta_img.dataobj.slope), float(cta_img.dataobj.inter)
+    header.set_slope_inter(slope, intercept)
+    scaled = (slope, intercept) != (1.0, 0.0)
+
+    # Stored value of 0 after scaling (what the multiplication by the mask used to give)
+    background = (0.0 - intercept) / slope
+    if np.issubdtype(dtype, np.integer):
+        background = np.clip(np.rint(background), np.iinfo(dtype).min, np.iinfo(dtype).max)
+
+    # Write the header, then fill the data slab by slab through a memory map of the uncompressed file
+    nii_path = output_path[:-3] if output_path.endswith(".gz") else output_path
+    with open(nii_path, "wb") as f:
+        header.write_to(f)
+        f.write(b"\x00" * (header.get_data_offset() - f.tell()))
+    data = np.memmap(nii_path, dtype=dtype, mode="r+", offset=header.get_data_offset(),
+                     shape=header.get_data_shape(), order="F")
+    for start in range(z0, z1, slab):
+        stop = min(start + slab, z1)
+        cta_slab = np.asanyarray(cta_img.dataobj[x0:x1, y0:y1, start:stop])
+        mask_slab = np.asanyarray(brain_mask_img.dataobj[x0:x1, y0:y1, start:stop]) > 0
+        if scaled:
+            # the proxy applies scl_slope/scl_inter; go back to the stored values
+            cta_slab = (cta_slab - intercept) / slope
+            if np.issubdtype(dtype, np.integer):
+                cta_slab = np.rint(cta_slab)
+        data[:, :, start - z0:stop - z0] = np.where(mask_slab, cta_slab, background).astype(dtype, copy=False)
+    data.flush()
+    del data
+
+    if nii_path != output_path:
+        os.replace(gzip_file(nii_path), output_path)
+    return box
+
+# Function to crop another image of the CTA grid (e.g. its brain mask) to the same box
+def crop_to_box(image_path, box, output_path):
+    """Crops an image on the grid of the CTA to the box returned by mask_and_crop and saves it."""
+    (x0, x1), (y0, y1), (z0, z1) = box
+    nib.save(nib.load(image_path).slicer[x0:x1, y0:y1, z0:z1], output_path)
+
+# Functions for the batch stage
+def _nifti_stem(name):
+    for extension in (".nii.gz", ".nii"):
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return None
+
+def find_pairs(cta_folder=cta_folder, brain_mask_folder=brain_mask_folder, builtin_mask_folder=None):
+    """Pairs every CTA with its TotalSegmentator brain mask, or else with its built-in mask in
+    builtin_mask_folder (computed later if it does not exist yet).
+    Returns ([(name, cta_path, brain_mask_path)], [names of the CTAs without TotalSegmentator mask]); with
+    builtin_mask_folder, these are paired with their built-in mask and still listed."""
+    pairs, missing = [], []
+    for name in sorted(os.listdir(cta_folder)):
+        stem = _nifti_stem(name)
+        if stem is None:
+            continue
+        brain_mask_path = os.path.join(brain_mask_folder, f"{stem}_brain_seg.nii.gz", "brain.nii.gz")
+        if os.path.exists(brain_mask_path):
+            pairs.append((stem, os.path.join(cta_folder, name), brain_mask_path))
+        else:
+            missing.append(stem)
+            if builtin_mask_folder is not None:
+                pairs.append((stem, os.path.join(cta_folder, name),
+                              os.path.join(builtin_mask_folder, f"{stem}_brain.nii.gz")))
+    return pairs, missing
+
+def is_up_to_date(output_path, *input_paths):
+    """True if output_path exists and is newer than every input."""
+    if not os.path.exists(output_path) or not all(os.path.exists(path) for path in input_paths):
+        return False
+    output_mtime = os.path.getmtime(output_path)
+    return all(os.path.getmtime(path) < output_mtime for path in input_paths)
+
+def _mask_and_crop_job(cta_path, brain_mask_path, output_path):
+    try:
+        if not os.path.exists(brain_mask_path):
+            # Built-in mask not computed yet
+            os.makedirs(os.path.dirname(brain_mask_path), exist_ok=True)
+            skull_strip_file(cta_path, brain_mask_path)
+        mask_and_crop(cta_path, brain_mask_path, output_path)
+    except Exception as e:
+        return f"Failed to mask {cta_path} with {brain_mask_path}: {e}"
+    return None
+
+def mask_all(pairs, output_folder=output_folder, workers=num_workers):
+    """Masks and crops every (name, cta_path, brain_mask_path) pair whose output is missing or older than
+    its inputs, in a process pool. Returns (number of pairs processed, list of error messages)."""
+    os.makedirs(output_folder, exist_ok=True)
+    jobs = [(cta_path, brain_mask_path, os.path.join(output_folder, f"{name}.nii.gz"))
+            for name, cta_path, brain_mask_path in pairs]
+    jobs = [job for job in jobs if not is_up_to_date(job[2], job[0], job[1])]
+    errors = []
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(_mask_and_crop_job, *job) for job in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Masking CTAs"):
+            if future.result() is not None:
+                errors.append(future.result())
+    return len(jobs), errors
+
+if __name__ == "__main__":
+    logging.basicConfig(filename="masking_errors.log", level=logging.ERROR, format="%(asctime)s - %(message)s")
+    start_time = time.time()
+
+    pairs, missing = find_pairs(builtin_mask_folder=builtin_mask_folder if use_builtin_masks else None)
+    if missing:
+        print(f"{len(missing)} CTAs have no TotalSegmentator brain mask:")
+        for name in missing:
+            print(f"  {name}" + (" (no TotalSegmentator mask, using built-in mask)" if use_builtin_masks else " (skipped)"))
+    n_processed, errors = mask_all(pairs)
+    for error in errors:
+        logging.error(error)
+    print(f"{len(pairs) - n_processed} of {len(pairs)} pairs up to date, {n_processed} masked, {len(errors)} failed")
+
+    end_time = time.time()
+    print(f"Processing completed in {end_time - start_time:.2f} seconds.")
@@ -0,0 +1,136 @@
+""" Fast brain masks for MR (TOF and T1) volumes, cached next to the NIfTI as <name>_brainmask.nii.gz.
+
+Steps, on a copy downsampled to working_spacing_mm:
+    1. bias reduction: N4 on a further shrunk copy, its bias field divided out of the working copy
+    2. Otsu thresholding (head against background)
+    3. binary opening, which cuts the brain loose from scalp and neck through the dark skull and CSF
+    4. largest connected component
+    5. binary closing and hole filling
+The mask is then upsampled to the full grid (linear interpolation of the mask, threshold 0.5). A mask covering
+less than minimum_mask_fraction of the image is rejected, so that a job does not register with it.
+
+Run as a script, masks are computed for every TOF and T1 in the series index (see Indexing_series.py)
+in a process pool; masks newer than their image are reused. get_brain_mask(path, "cta") caches the
+skull stripping of Skull_stripping_CTA.py the same way, for CTAs given to the registration as masks."""
+
+import logging
+import math
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import SimpleITK as sitk
+from tqdm import tqdm
+
+from Indexing_series import index_name, open_index
+from Skull_stripping_CTA import downsample, skull_strip_cta
+
+# Folder holding the converted NIfTI files and the series index
+base_dir = '/data/golubeka/EBRAINS/Nifti_T1_images'
+mr_roles = ["tof", "t1_3d", "t1"]
+
+working_spacing_mm = 2.0
+bias_shrink_factor = 3  # the bias field is smooth, a 6 mm grid is enough
+opening_radius_mm = 5.0
+closing_radius_mm = 4.0
+
+# Masks covering less than this fraction of the image are rejected (the thresholding found no brain)
+minimum_mask_fraction = 0.01
+
+# Number of masks computed at the same time
+num_workers = os.cpu_count() or 1
+
+# Function to name the cached mask of an image
+def brain_mask_path(nifti_path):
+    """<folder>/<name>.nii.gz -> <folder>/<name>_brainmask.nii.gz"""
+    for extension in (".nii.gz", ".nii"):
+        if nifti_path.endswith(extension):
+            return nifti_path[:-len(extension)] + "_brainmask.nii.gz"
+    return nifti_path + "_brainmask.nii.gz"
+
+def _radius(radius_mm, image):
+    return [max(1, int(math.ceil(radius_mm / s))) for s in image.GetSpacing()]
+
+# Function to reduce the intensity bias of the working copy
+def reduce_bias(small):
+    """Divides out the N4 bias field, estimated on a copy shrunk by bias_shrink_factor."""
+    small = sitk.Threshold(small, 0.0, 1e30, 0.0) + 1.0  # N4 works on positive intensities
+    head = sitk.OtsuThreshold(small, 0, 1)
+    shrunk = sitk.Shrink(small, [bias_shrink_factor] * small.GetDimension())
+    shrunk_head = sitk.Shrink(head, [bias_shrink_factor] * small.GetDimension())
+    corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    corrector.SetMaximumNumberOfIterations([20, 10, 5])
+    corrector.Execute(shrunk, shrunk_head)
+    log_bias = corrector.GetLogBiasFieldAsImage(small)
+    return small / sitk.Exp(log_bias)
+
+# Function to compute the brain mask of an MR image
+def mr_brain_mask(image):
+    """Returns a UInt8 brain mask (1 = brain) on the grid of image."""
+    small = reduce_bias(downsample(image, working_spacing_mm, default_value=0))
+
+    brain = sitk.OtsuThreshold(small, 0, 1)
+    brain = sitk.BinaryMorphologicalOpening(brain, _radius(opening_radius_mm, small))
+    components = sitk.RelabelComponent(sitk.ConnectedComponent(brain), sortByObjectSize=True)
+    brain = sitk.BinaryThreshold(components, 1, 1, 1, 0)
+    if sitk.GetArrayViewFromImage(brain).max() == 0:
+        raise ValueError("No brain found in the image")
+    brain = sitk.BinaryMorphologicalClosing(brain, _radius(closing_radius_mm, small))
+    brain = sitk.BinaryFillhole(brain)
+
+    brain = sitk.Resample(sitk.Cast(brain, sitk.sitkFloat32), image, sitk.Transform(), sitk.sitkLinear, 0.0)
+    return sitk.BinaryThreshold(brain, 0.5, 2.0, 1, 0)
+
+# Function returning the cached mask of an image, computing it when needed
+def get_brain_mask(nifti_path, modality="mr"):
+    """Returns the path of the brain mask of nifti_path, computing it if it is missing or older than the image.
+    modality is "mr" (TOF, T1) or "cta". Raises ValueError for a mask under minimum_mask_fraction of the image."""
+    if modality not in ("mr", "cta"):
+        raise ValueError(f"Unknown modality {modality} for a brain mask, use mr or cta")
+    mask_path = brain_mask_path(nifti_path)
+    if not os.path.exists(mask_path) or os.path.getmtime(mask_path) < os.path.getmtime(nifti_path):
+        image = sitk.ReadImage(nifti_path, sitk.sitkFloat32)
+        brain_mask = skull_strip_cta(image) if modality == "cta" else mr_brain_mask(image)
+        fraction = float(sitk.GetArrayViewFromImage(brain_mask).mean())
+        if fraction < minimum_mask_fraction:
+            raise ValueError(f"The brain mask of {nifti_path} covers only {100 * fraction:.2f}% of the image")
+        # A unique temporary file: parallel registration jobs may compute the mask of the same image
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(mask_path)), suffix=".nii.gz",
+                                         delete=False) as f:
+            pass
+        try:
+            sitk.WriteImage(brain_mask, f.name, useCompression=True)
+            os.replace(f.name, mask_path)
+        except Exception:
+            os.remove(f.name)
+            raise
+    return mask_path
+
+def _get_brain_mask_job(nifti_path):
+    try:
+        get_brain_mask(nifti_path)
+    except Exception as e:
+        return f"Failed to compute the brain mask of {nifti_path}: {e}"
+    return None
+
+if __name__ == "__main__":
+    logging.basicConfig(filename="masking_errors.log", level=logging.ERROR, format="%(asctime)s - %(message)s")
+    start_time = time.time()
+
+    with open_index(os.path.join(base_dir, index_name)) as conn:
+        placeholders = ", ".join("?" for _ in mr_roles)
+        nifti_paths = [row["nifti_path"] for row in conn.execute(
+            f"SELECT nifti_path FROM series WHERE role IN ({placeholders}) AND nifti_path IS NOT NULL", mr_roles)]
+
+    errors = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_get_brain_mask_job, path) for path in nifti_paths]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Masking MR images"):
+            if future.result() is not None:
+                errors.append(future.result())
+                logging.error(future.result())
+    print(f"{len(nifti_paths) - len(errors)} MR brain masks up to date, {len(errors)} failed")
+
+    end_time = time.time()
+    print(f"Processing completed in {end_time - start_time:.2f} seconds.")
@@ -8,7 +8,7 @@ import os
 # Define file paths
 # =========================
 registered_atlas_path = '/data/golubeka/EBRAINS/Atlases/DIFUMO_ATLAS_64_DIMENSIONS.nii'  # Path to your labeled atlas file
-tof_path = "/data/golubeka/EBRAINS/Nifti_T1_images/ToF-3D-multi-s2_anevrisme_-_6.nii.gz"                # Path to the registered TOF file
+tof_path = "/data/golubeka/EBRAINS/Nifti_T1_images/Patient_1712/ToF-3D-multi-s2_anevrisme_-_6.nii.gz"                # Path to the registered TOF file
 
 # =========================
 # Load the registered files
@@ -119,7 +119,7 @@ from time import time
 # Define file paths
 # ==========================
 
-fixed_image_path = "/data/golubeka/EBRAINS/Nifti_T1_images/ToF-3D-multi-s2_anevrisme_-_6.nii.gz"   # TOF image (Fixed)
+fixed_image_path = "/data/golubeka/EBRAINS/Nifti_T1_images/Patient_1712/ToF-3D-multi-s2_anevrisme_-_6.nii.gz"   # TOF image (Fixed)
 moving_image_path = '/data/golubeka/EBRAINS/Atlases/DIFUMO_ATLAS_64_DIMENSIONS.nii'     # Atlas (Moving)
 result_registered_path = '/data/golubeka/EBRAINS/Atlases/DIFUMO_ATLAS_REGISTERED.nii'  # Output path for registered atlas
 
@@ -252,7 +252,7 @@ import matplotlib.pyplot as plt
 # ==========================
 # Define file paths
 # ==========================
-tof_path = '/data/golubeka/EBRAINS/Nifti_T1_images/ToF-3D-multi-s2_anevrisme_-_6.nii.gz'            # Path to TOF image
+tof_path = '/data/golubeka/EBRAINS/Nifti_T1_images/Patient_1712/ToF-3D-multi-s2_anevrisme_-_6.nii.gz'            # Path to TOF image
 registered_atlas_path = '/data/golubeka/EBRAINS/Atlases/DIFUMO_ATLAS_REGISTERED.nii'  # Path to registered atlas
 
 # ==========================
@@ -1,42 +1,34 @@
-import SimpleITK as sitk
 import time
-import nibabel as nib
-import numpy as np
 import os
-from tqdm import tqdm
+
+from Masking_CTA import crop_to_box, mask_and_crop
 
 # Simple elastix doens't do skull stripping so we need to do it manually (?) or use TotalSegmentator 
-# For CTA we need to crop the image to the brain first before registering.
+# (Skull_stripping_CTA.py computes a brain mask in seconds when there is no TotalSegmentator mask)
+# The brain-only CTA is cropped to the brain, and the brain mask to the same box; the registration uses the
+# cropped CTA with the cropped mask as elastix moving mask, so elastix's pyramids are built on the small
+# image, the metric is sampled inside the brain and the edge of the zeroed background does not drive it.
 
 # Paths
 cta_path = '/data/golubeka/data2024-mock/Processed_v1_nifti/CT_converted/ANGIO_CT._20160310130837_4.nii.gz'
 brain_mask_path = '/data/golubeka/data2024-mock/Processed_v1_nifti/CT_converted_brain/ANGIO_CT._20160310130837_4_brain_seg.nii.gz/brain.nii.gz'
 output_path = '/data/golubeka/EBRAINS/CTA/cta_brain_cropped.nii.gz'
+cropped_mask_path = '/data/golubeka/EBRAINS/CTA/cta_brain_cropped_mask.nii.gz'
 os.makedirs('/data/golubeka/EBRAINS/CTA/', exist_ok=True)
+crop_margin_mm = 5.0  # Margin kept around the brain mask bounding box
 
 # Timer start
 start_time = time.time()
 
+# Registered below: the cropped pair, or the full CTA with its mask if cropping fails
+moving_path, moving_mask_path = cta_path, brain_mask_path
 try:
-    # Load the images
-    print("Loading CTA and brain mask...")
-    cta_img = nib.load(cta_path)
-    brain_mask_img = nib.load(brain_mask_path)
-    
-    cta_data = cta_img.get_fdata()
-    brain_mask_data = brain_mask_img.get_fdata()
-    
-    # Keep only brain voxels
-    print("Applying brain mask to keep only brain voxels...")
-    brain_only_cta_data = cta_data * brain_mask_data  # Element-wise multiplication
-    
-    # Create a new NIfTI image with the brain-only data
-    brain_only_cta_img = nib.Nifti1Image(brain_only_cta_data, affine=cta_img.affine)
-    
-    # Save the brain-only image
-    print("Saving brain-only CTA image...")
-    nib.save(brain_only_cta_img, output_path)
-    
+    # Keep only brain voxels and crop to the brain, see Masking_CTA.py
+    print("Applying brain mask and cropping to the brain bounding box...")
+    box = mask_and_crop(cta_path, brain_mask_path, output_path, margin_mm=crop_margin_mm)
+    crop_to_box(brain_mask_path, box, cropped_mask_path)
+    moving_path, moving_mask_path = output_path, cropped_mask_path
+    print(f"Cropped to voxels {box}")
     print(f"Brain-only CTA image saved to {output_path}")
 except Exception as e:
     print(f"An error occurred: {e}")
@@ -48,37 +40,25 @@ print(f"Processing completed in {end_time - start_time:.2f} seconds.")
 
 
 ######################################### Coregistration #########################################
-import SimpleITK as sitk
-
-# Load images
-fixedImage = sitk.ReadImage('/data/golubeka/EBRAINS/Atlases/DIFUMO_ATLAS_64_DIMENSIONS.nii')
-movingImage = sitk.ReadImage('/data/golubeka/EBRAINS/CTA/cta_brain_cropped.nii.gz')
-
-# Set up ElastixImageFilter
-elastixImageFilter = sitk.ElastixImageFilter()
-elastixImageFilter.SetFixedImage(fixedImage)
-elastixImageFilter.SetMovingImage(movingImage)
+from Registering_batch import run_job
 
-# Add parameter maps (translation, rigid, affine)
-parameterMap1 = sitk.GetDefaultParameterMap("translation")
-parameterMap2 = sitk.GetDefaultParameterMap("rigid")
-parameterMap3 = sitk.GetDefaultParameterMap("affine")
+# Rigid and affine registration of the CTA to the atlas, started from the alignment of the image moments,
+# inside the brain mask (job fields: see Registering_batch.py). To start from a precomputed initial transform
+# instead, drop "initializer" and give "parameters": {"InitialTransformParameterFileName": path}; with an
+# initializer, run_job gives elastix its own InitialTransform.txt and the two would collide.
+job = {
+    "name": 'CTA_brain_to_atlas',
+    "fixed": '/data/golubeka/EBRAINS/Atlases/DIFUMO_ATLAS_64_DIMENSIONS.nii',
+    "moving": moving_path,
+    "moving_mask": moving_mask_path,
+    "stages": ["rigid", "affine"],
+    "initializer": "moments",
+    "outputs": {"result_image": '/data/golubeka/EBRAINS/Atlases/registered_difumo_atlas_to_cta_brain_cropped.nii.gz'},
+}
 
-# If you want to include an initial transform, configure the parameter maps accordingly
-parameterMap1["InitialTransform"] = ["NoInitialTransform"]  # Default; no initial transform
-# Uncomment below if there's a precomputed transform:
-# parameterMap1["InitialTransform"] = ["path/to/initial/transform.txt"]
-
-# Add the parameter maps
-elastixImageFilter.SetParameterMap(parameterMap1)
-elastixImageFilter.AddParameterMap(parameterMap2)
-elastixImageFilter.AddParameterMap(parameterMap3)
-
-# Execute the registration
 print("Starting registration...")
-elastixImageFilter.Execute()
-
-# Save the result
-resultImage = elastixImageFilter.GetResultImage()
-sitk.WriteImage(resultImage, '/data/golubeka/EBRAINS/Atlases/registered_difumo_atlas_to_cta_brain_cropped.nii.gz')
-print("Registration completed and saved.")
+result = run_job(job)
+if result["error"]:
+    print(f"An error occurred: {result['error']}")
+else:
+    print(f"Registration completed and saved in {result['seconds']:.2f} seconds.")
@@ -1,58 +1,29 @@
-import SimpleITK as sitk
 from time import time
 
-# ==========================
-# Define file paths
-# ==========================
-fixed_image_path = '/data/golubeka/EBRAINS/Nifti_T1_images/ToF-3D-multi-s2_anevrisme_-_6.nii.gz'  # TOF image (Fixed)
-moving_image_path = '/data/golubeka/EBRAINS/Atlases/DIFUMO_ATLAS_64_DIMENSIONS.nii'  # Atlas (Moving)
-result_path = '/data/golubeka/EBRAINS/Nifti_T1_images/registered_difumo_atlas_to_tof.nii.gz'
-
-# ==========================
-# Load images
-# ==========================
-fixedImage = sitk.ReadImage(fixed_image_path)
-movingImage = sitk.ReadImage(moving_image_path)
-
-# Set up ElastixImageFilter for registration
-elastixImageFilter = sitk.ElastixImageFilter()
-elastixImageFilter.SetFixedImage(fixedImage)
-elastixImageFilter.SetMovingImage(movingImage)
-
-# Define parameter maps for registration
-parameterMap1 = sitk.GetDefaultParameterMap("translation")
-parameterMap2 = sitk.GetDefaultParameterMap("rigid")
-parameterMap3 = sitk.GetDefaultParameterMap("affine")
-
-# Add parameter maps to the ElastixImageFilter
-elastixImageFilter.SetParameterMap(parameterMap1)
-elastixImageFilter.AddParameterMap(parameterMap2)
-elastixImageFilter.AddParameterMap(parameterMap3)
-
-# Time the registration
-start_time = time()
-elastixImageFilter.Execute()
+from Registering_batch import run_job
 
 # ==========================
-# Resample Moving Image Using Transformix
+# Registration job (fields: see Registering_batch.py)
 # ==========================
-# Set up TransformixImageFilter for resampling
-transformixImageFilter = sitk.TransformixImageFilter()
-transformixImageFilter.SetTransformParameterMap(elastixImageFilter.GetTransformParameterMap())
-transformixImageFilter.SetMovingImage(movingImage)
-
-# Execute Transformix to apply the transform
-transformixImageFilter.Execute()
-
-# Get the resampled (registered) atlas
-resultImage = transformixImageFilter.GetResultImage()
-
-# Save the registered atlas
-sitk.WriteImage(resultImage, result_path)
+job = {
+    "name": 'atlas_to_TOF',
+    "fixed": '/data/golubeka/EBRAINS/Nifti_T1_images/Patient_1712/ToF-3D-multi-s2_anevrisme_-_6.nii.gz',  # TOF image (Fixed)
+    "moving": '/data/golubeka/EBRAINS/Atlases/DIFUMO_ATLAS_64_DIMENSIONS.nii',  # Atlas (Moving)
+    "stages": ["rigid", "affine"],
+    "initializer": "moments",
+    # The atlas is resampled with transformix onto the TOF grid
+    "outputs": {"result_image": '/data/golubeka/EBRAINS/Nifti_T1_images/registered_difumo_atlas_to_tof.nii.gz'},
+}
 
 # ==========================
-# Print execution time
+# Register and print execution time
 # ==========================
-end_time = time()
-print(f"Registration completed in {end_time - start_time:.2f} seconds")
-print(f"Result saved to {result_path}")
+if __name__ == '__main__':
+    start_time = time()
+    result = run_job(job)
+    end_time = time()
+    print(f"Registration {result['status']} in {end_time - start_time:.2f} seconds {result['timings']}")
+    if result["error"]:
+        print(f"An error occurred: {result['error']}")
+    else:
+        print(f"Result saved to {result['result_image']}")
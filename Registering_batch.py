@@ -0,0 +1,555 @@
+""" Batch registration with SimpleElastix, driven by a YAML job file.
+
+Usage: python Registering_batch.py registration_jobs.yaml [number of parallel jobs | auto]
+With auto (the default), Scheduling_registration.py picks the number of parallel jobs and the threads per job
+from a micro-benchmark of the node.
+
+Job file (see registration_jobs.yaml):
+    defaults:                      # merged into every job
+      stages: [translation, rigid, affine]
+      output_folder: /data/golubeka/EBRAINS/Registrations
+    jobs:
+      - name: TOF_to_T1_1712       # unique, also the name of the job folder
+        fixed: /path/to/T1.nii.gz
+        moving: /path/to/TOF.nii.gz
+        stages: [translation, rigid, affine]      # sitk.GetDefaultParameterMap names
+        parameters: {FinalBSplineInterpolationOrder: 4}          # overrides for every stage
+        stage_parameters: {rigid: {MaximumNumberOfIterations: 512}}  # overrides per stage
+        preset: fast                                # preview, fast, balanced or accurate (see Registration_presets.py),
+                                                    # or per stage: {rigid: fast, affine: fast, bspline: fast}
+        fixed_mask: mr_brain                        # metric sampled only inside the masks: a mask file, or mr_brain /
+        moving_mask: /path/to/TOF_brainmask.nii.gz  # cta_brain for the cached brain mask (see Masking_MR_brain.py)
+        result_interpolator: nearest                # nearest, linear or bspline (default) for the result image
+        threads: 4                                  # elastix/ITK threads of the job (default: cores / parallel jobs)
+        match_resolution: auto                      # true, false or auto (= only when all stages are linear)
+        initializer: moments                        # moments or geometry: initial translation, no translation stage
+        cache: true                                 # reuse the result of identical images and parameter maps
+        reuse_inverse: true                         # invert the cached registration of the reversed pair
+                                                    # instead of registering again (see Inverting_transforms.py);
+                                                    # registers anyway if the inverse field does not converge
+        iteration_budget: tof_to_t1                 # group of similar jobs: iterations capped at the plateaus
+                                                    # recorded by earlier jobs (see Monitoring_convergence.py)
+        outputs: {result_image: /path/to/registered.nii.gz}
+
+Resolution matching: the finer of the two images is resampled (with anti-aliasing) to the finest spacing of
+the coarser one before elastix, e.g. a 0.4 mm CTA to the 1.875 mm grid of the atlas, so that the pyramids
+of a linear registration are not built at full resolution. Transforms are in physical coordinates, so they
+apply unchanged to the full-resolution images; the output grid of the maps is set back to the original
+fixed image.
+
+Every job writes into <output_folder>/<name>/: elastix.log, TransformParameters.<i>.txt, convergence.json
+(the metric of every iteration per stage and resolution) and job.json (status, error, timings, iterations
+run and useful per stage and resolution). The runner prints a summary with the failures and writes it to
+registration_summary.json in the output folder of the first job."""
+
+import copy
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import SimpleITK as sitk
+import yaml
+from tqdm import tqdm
+
+from Caching_registration import (cached_result_image, image_digest, lookup, registration_key, store,
+                                  store_result_image)
+from Masking_MR_brain import get_brain_mask
+from Monitoring_convergence import convergence_summary, iteration_budgets, parse_iteration_log, record_convergence
+from Registration_presets import preset_parameters
+from Skull_stripping_CTA import downsample
+
+# Default folder of the job folders
+output_root = '/data/golubeka/EBRAINS/Registrations'
+
+# Cache of registration results (see Caching_registration.py); a job can set cache_folder or cache: false
+cache_root = os.path.join(output_root, '.registration_cache')
+
+# Recorded plateaus of the iteration_budget groups (see Monitoring_convergence.py); a job can set budget_folder
+budget_root = os.path.join(output_root, 'iteration_budgets')
+
+# Number of cores this process may use (taskset/cgroup limits included)
+num_cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+# Number of registrations run at the same time
+num_workers = num_cores
+
+linear_stages = {"translation", "rigid", "euler", "similarity", "affine"}
+
+# Spacing of the binned copies the initializer computes its moments on
+initializer_spacing_mm = 4.0
+
+# Intensity floor of the moments, between CT air and soft tissue (HU): air and the padding outside the
+# reconstruction field of view (-2048, -3024) weigh 0 and do not pull the centre towards the middle of the
+# field of view (MR intensities are above it and keep their own minimum)
+initializer_floor = -500.0
+
+# An image is downsampled only if its finest spacing is this many times finer than the target spacing
+resolution_match_ratio = 1.5
+
+interpolators = {
+    "nearest": "FinalNearestNeighborInterpolator",  # label images such as atlases
+    "linear": "FinalLinearInterpolator",
+    "bspline": "FinalBSplineInterpolator",          # elastix default
+}
+
+# Functions to read the job file
+def _merge(defaults, job):
+    """Job values override defaults; dict values (parameters, stage_parameters, outputs) are merged."""
+    merged = copy.deepcopy(defaults)
+    for key, value in job.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+def load_jobs(job_file):
+    """Returns the jobs of a YAML job file, with the defaults merged in."""
+    with open(job_file) as f:
+        document = yaml.safe_load(f) or {}
+    defaults = document.get("defaults", {})
+    jobs = [_merge(defaults, job) for job in document.get("jobs", [])]
+    names = set()
+    for job in jobs:
+        missing = [key for key in ("name", "fixed", "moving") if key not in job]
+        if missing:
+            raise ValueError(f"Job {job.get('name', '?')} in {job_file} has no {', '.join(missing)}")
+        if job["name"] in names:
+            raise ValueError(f"Job name {job['name']} is used twice in {job_file}")
+        names.add(job["name"])
+    return jobs
+
+# Functions to build the elastix parameter maps
+def _strings(value):
+    """Parameter map values are lists of strings; YAML gives numbers, booleans and lists."""
+    if isinstance(value, (list, tuple)):
+        return [item for v in value for item in _strings(v)]
+    if isinstance(value, bool):
+        return ["true" if value else "false"]
+    return [str(value)]
+
+def parameter_maps(job):
+    """Returns one sitk.ParameterMap per stage: the elastix defaults, the job's preset, the mask settings,
+    then the job's overrides, with the iterations capped by the job's iteration budget."""
+    maps = []
+    for stage in job.get("stages", ["translation", "rigid", "affine"]):
+        parameter_map = sitk.GetDefaultParameterMap(stage)
+        preset = job.get("preset")
+        preset = preset.get(stage) if isinstance(preset, dict) else preset
+        if preset:
+            for key, value in preset_parameters(preset, stage).items():
+                parameter_map[key] = _strings(value)
+        if job.get("fixed_mask") or job.get("moving_mask"):
+            # The masks are brain masks already, do not shrink them; samples that land outside the moving
+            # mask are redrawn
+            parameter_map["ErodeMask"] = ["false"]
+            parameter_map["MaximumNumberOfSamplingAttempts"] = ["10"]
+        if job.get("fixed_mask"):
+            # Samples drawn from the voxels of the fixed mask directly, instead of drawing coordinates in
+            # the whole image and rejecting those outside the mask
+            parameter_map["ImageSampler"] = ["RandomSparseMask"]
+        elif job.get("moving_mask"):
+            # Without a fixed mask most samples of the fixed image (e.g. a whole atlas) fall outside a moving
+            # brain mask; those are dropped instead of failing the registration (elastix default: 25% valid)
+            parameter_map["RequiredRatioOfValidSamples"] = ["0.05"]
+        overrides = dict(job.get("parameters", {}), **job.get("stage_parameters", {}).get(stage, {}))
+        for key, value in overrides.items():
+            parameter_map[key] = _strings(value)
+        if job.get("iteration_budget"):
+            _apply_iteration_budget(parameter_map, stage, job)
+        # elastix writes no result image files; the result is taken in memory from GetResultImage
+        parameter_map["WriteResultImage"] = ["false"]
+        maps.append(parameter_map)
+    return maps
+
+def _apply_iteration_budget(parameter_map, stage, job):
+    """Caps MaximumNumberOfIterations of every resolution at the learned budget of the job's group."""
+    resolutions = int(parameter_map["NumberOfResolutions"][0])
+    budget = iteration_budgets(job.get("budget_folder", budget_root), job["iteration_budget"], stage, resolutions)
+    if budget is None:
+        return
+    configured = [int(n) for n in parameter_map["MaximumNumberOfIterations"]]
+    configured = configured * resolutions if len(configured) == 1 else configured
+    parameter_map["MaximumNumberOfIterations"] = [str(min(c, b)) for c, b in zip(configured, budget)]
+
+# Function to find the masks of a job
+def mask_paths(job):
+    """{"fixed": path or None, "moving": path or None}; mr_brain and cta_brain give the cached brain mask
+    of the image (computed on first use)."""
+    masks = {}
+    for side in ("fixed", "moving"):
+        value = job.get(f"{side}_mask")
+        if value in ("mr_brain", "cta_brain"):
+            value = get_brain_mask(job[side], value.split("_")[0])
+        masks[side] = value or None
+    return masks
+
+def _mask_on_grid(mask_path, image):
+    """The mask as UInt8, resampled (nearest neighbour) onto the grid of the image given to elastix."""
+    mask = sitk.ReadImage(mask_path, sitk.sitkUInt8)
+    if (mask.GetSize(), mask.GetSpacing(), mask.GetOrigin(), mask.GetDirection()) != \
+            (image.GetSize(), image.GetSpacing(), image.GetOrigin(), image.GetDirection()):
+        mask = sitk.Resample(mask, image, sitk.Transform(), sitk.sitkNearestNeighbor, 0)
+    return mask
+
+def job_folder(job):
+    return os.path.join(job.get("output_folder", output_root), job["name"])
+
+# Functions to match the resolution of the two images
+def match_resolution(fixed, moving, ratio=resolution_match_ratio):
+    """Downsamples the finer image to the finest spacing of the coarser one (anti-aliased, never upsampled).
+    Returns the (fixed, moving) pair given to elastix."""
+    target = max(min(fixed.GetSpacing()), min(moving.GetSpacing()))
+    def match(image):
+        if min(image.GetSpacing()) * ratio > target:
+            return image
+        return downsample(image, target, default_value=0)
+    return match(fixed), match(moving)
+
+# Functions for the initial transform
+def initial_translation(fixed, moving, mode="moments", fixed_mask=None, moving_mask=None):
+    """Translation (fixed -> moving points) that brings together the centres of mass of the images (moments,
+    inside the masks if given) or the centres of their extents (geometry), computed on copies binned to about
+    initializer_spacing_mm."""
+    def binned(image, mask_path):
+        image = sitk.BinShrink(image, [max(1, int(round(initializer_spacing_mm / s))) for s in image.GetSpacing()])
+        # non-negative weights from the floor up
+        floor = max(float(sitk.GetArrayViewFromImage(image).min()), initializer_floor)
+        image = sitk.Maximum(image, floor) - floor
+        if mask_path:
+            image = image * sitk.Cast(_mask_on_grid(mask_path, image), sitk.sitkFloat32)
+        return image
+    modes = {"moments": sitk.CenteredTransformInitializerFilter.MOMENTS,
+             "geometry": sitk.CenteredTransformInitializerFilter.GEOMETRY}
+    if mode not in modes:
+        raise ValueError(f"Unknown initializer {mode!r}, expected one of {sorted(modes)}")
+    transform = sitk.CenteredTransformInitializer(binned(fixed, fixed_mask), binned(moving, moving_mask),
+                                                  sitk.Euler3DTransform(), modes[mode])
+    return transform.GetTranslation()
+
+def translation_map(translation, fixed):
+    """Elastix TranslationTransform map on the grid of the fixed image."""
+    values = {
+        "Transform": ["TranslationTransform"],
+        "NumberOfParameters": [str(len(translation))],
+        "TransformParameters": [repr(float(t)) for t in translation],
+        "InitialTransformParameterFileName": ["NoInitialTransform"],
+        "HowToCombineTransforms": ["Compose"],
+        "FixedImageDimension": [str(fixed.GetDimension())],
+        "MovingImageDimension": [str(fixed.GetDimension())],
+        "FixedInternalImagePixelType": ["float"],
+        "MovingInternalImagePixelType": ["float"],
+        "UseDirectionCosines": ["true"],
+        "ResampleInterpolator": ["FinalBSplineInterpolator"],
+        "FinalBSplineInterpolationOrder": ["3"],
+        "Resampler": ["DefaultResampler"],
+        "DefaultPixelValue": ["0"],
+        "ResultImageFormat": ["nii"],
+        "ResultImagePixelType": ["float"],
+        "CompressResultImage": ["false"],
+    }
+    transform_map = sitk.ParameterMap()
+    for key, value in values.items():
+        transform_map[key] = value
+    return set_output_grid([transform_map], fixed)[0]
+
+def _matches_resolution(job):
+    setting = job.get("match_resolution", "auto")
+    if setting == "auto":
+        return all(stage in linear_stages for stage in job.get("stages", ["translation", "rigid", "affine"]))
+    return bool(setting)
+
+def set_output_grid(transform_maps, image):
+    """Makes the maps resample onto the grid of image (transformix uses the fixed image grid of the last map)."""
+    transform_maps = [sitk.ParameterMap(transform_map) for transform_map in transform_maps]
+    for transform_map in transform_maps:
+        transform_map["Size"] = [str(n) for n in image.GetSize()]
+        transform_map["Index"] = ["0"] * image.GetDimension()
+        transform_map["Spacing"] = [repr(s) for s in image.GetSpacing()]
+        transform_map["Origin"] = [repr(o) for o in image.GetOrigin()]
+        transform_map["Direction"] = [repr(d) for d in image.GetDirection()]
+    return transform_maps
+
+# Functions for transform parameter files
+def write_transform_chain(transform_maps, folder, prefix="TransformParameters"):
+    """Writes the maps as <prefix>.<i>.txt, each pointing to the previous one as its initial transform.
+    Returns the paths of the files."""
+    paths = []
+    for i, transform_map in enumerate(transform_maps):
+        transform_map = sitk.ParameterMap(transform_map)
+        transform_map["InitialTransformParameterFileName"] = [paths[-1] if paths else "NoInitialTransform"]
+        path = os.path.abspath(os.path.join(folder, f"{prefix}.{i}.txt"))
+        sitk.WriteParameterFile(transform_map, path)
+        paths.append(path)
+    return paths
+
+def read_transform_chain(paths):
+    return [sitk.ReadParameterFile(path) for path in paths]
+
+# Function to resample an image with a chain of transforms
+def resample(moving, transform_maps, interpolator="bspline", output_folder=None):
+    """Applies the transform maps to moving with transformix (one resampling pass)."""
+    transform_maps = [sitk.ParameterMap(transform_map) for transform_map in transform_maps]
+    transform_maps[-1]["ResampleInterpolator"] = [interpolators[interpolator]]
+    transformix = sitk.TransformixImageFilter()
+    transformix.LogToConsoleOff()
+    if output_folder is not None:
+        transformix.SetOutputDirectory(output_folder)
+    transformix.SetMovingImage(moving)
+    transformix.SetTransformParameterMap(transform_maps[0])
+    for transform_map in transform_maps[1:]:
+        transformix.AddTransformParameterMap(transform_map)
+    transformix.Execute()
+    result = transformix.GetResultImage()
+    if interpolator == "nearest":
+        result = sitk.Cast(result, moving.GetPixelID())  # keep labels as labels
+    return result
+
+# Function to run elastix for one job
+def _register(job, maps, masks, folder, lap, result):
+    """Runs elastix on the (resolution-matched) images of the job, restricted to the masks. Returns the transform maps, the moving
+    image and the result image of elastix when it can be used as the job's result image, else None."""
+    fixed = sitk.ReadImage(job["fixed"], sitk.sitkFloat32)
+    moving = sitk.ReadImage(job["moving"])
+    lap("load")
+
+    float_moving = sitk.Cast(moving, sitk.sitkFloat32)
+    registration_fixed, registration_moving = fixed, float_moving
+    if _matches_resolution(job):
+        registration_fixed, registration_moving = match_resolution(fixed, float_moving)
+        result["registration_spacing"] = {"fixed": registration_fixed.GetSpacing(),
+                                          "moving": registration_moving.GetSpacing()}
+        lap("match_resolution")
+
+    # Set up ElastixImageFilter, logging to the job folder
+    elastix = sitk.ElastixImageFilter()
+    elastix.SetOutputDirectory(folder)
+    elastix.LogToFileOn()
+    elastix.LogToConsoleOff()
+    if job.get("threads"):
+        elastix.SetNumberOfThreads(int(job["threads"]))
+    elastix.SetFixedImage(registration_fixed)
+    elastix.SetMovingImage(registration_moving)
+    if masks["fixed"]:
+        elastix.SetFixedMask(_mask_on_grid(masks["fixed"], registration_fixed))
+    if masks["moving"]:
+        elastix.SetMovingMask(_mask_on_grid(masks["moving"], registration_moving))
+
+    initial_maps = []
+    if job.get("initializer"):
+        translation = initial_translation(registration_fixed, registration_moving, job["initializer"],
+                                          masks["fixed"], masks["moving"])
+        initial_maps = [translation_map(translation, registration_fixed)]
+        initial_file = os.path.join(folder, "InitialTransform.txt")
+        sitk.WriteParameterFile(initial_maps[0], initial_file)
+        elastix.SetInitialTransformParameterFileName(initial_file)
+        result["initial_translation"] = [round(t, 3) for t in translation]
+        lap("initializer")
+    elastix.SetParameterMap(maps[0])
+    for parameter_map in maps[1:]:
+        elastix.AddParameterMap(parameter_map)
+    elastix.Execute()
+    lap("register")
+
+    # elastix leaves its own copy of the result image in the output folder; the initial transform is
+    # written again as the first map of the chain
+    for name in os.listdir(folder):
+        if (name.startswith("result.") and name.endswith(".nii")) or name == "InitialTransform.txt":
+            os.remove(os.path.join(folder, name))
+
+    # Metric of every iteration, and the iterations spent after the plateau
+    stages = job.get("stages", ["translation", "rigid", "affine"])
+    trace = parse_iteration_log(os.path.join(folder, "elastix.log"))
+    with open(os.path.join(folder, "convergence.json"), "w") as f:
+        json.dump([{"stage": stage, "resolutions": resolutions} for stage, resolutions in zip(stages, trace)], f)
+    result["convergence"] = convergence_summary(trace, stages)
+    if job.get("iteration_budget"):
+        record_convergence(job.get("budget_folder", budget_root), job["iteration_budget"], job["name"],
+                           result["convergence"])
+
+    transform_maps = initial_maps + list(elastix.GetTransformParameterMap())
+    if registration_fixed is not fixed:
+        transform_maps = set_output_grid(transform_maps, fixed)
+    # The last stage resampled the moving image with the default interpolator; usable unless downsampled
+    full_resolution = registration_fixed is fixed and registration_moving is float_moving
+    if (job.get("result_interpolator", "bspline") == "bspline" and moving.GetPixelID() == sitk.sitkFloat32
+            and full_resolution):
+        return transform_maps, moving, elastix.GetResultImage()
+    return transform_maps, moving, None
+
+# Function to key a job in the cache
+def _cache_key(job, maps, masks, cache_folder, reverse=False):
+    """Cache key of the job, or with reverse of the same registration with fixed and moving swapped."""
+    fixed, moving = ("moving", "fixed") if reverse else ("fixed", "moving")
+    options = {"match_resolution": _matches_resolution(job), "initializer": job.get("initializer")}
+    for side, role in (("fixed", fixed), ("moving", moving)):
+        if masks[role]:
+            options[f"{side}_mask"] = image_digest(masks[role], cache_folder)
+    # Keyed on the maps without the learned iteration budget: the budget changes with every recorded job,
+    # and a capped run stands for the same registration
+    key_maps = parameter_maps(dict(job, iteration_budget=None)) if job.get("iteration_budget") else maps
+    return registration_key(job[fixed], job[moving], key_maps, options, cache_folder)
+
+# Function to run one job
+def run_job(job):
+    """Registers job["moving"] to job["fixed"] and writes the job outputs. Never raises: the returned
+    result (also written to job.json) holds the status, the error and the timings.
+    Identical registrations are restored from the cache (see Caching_registration.py)."""
+    folder = job_folder(job)
+    os.makedirs(folder, exist_ok=True)
+    result = {"name": job["name"], "status": "failed", "error": None, "timings": {}, "transform_files": [],
+              "fixed": job["fixed"], "moving": job["moving"]}
+    start_time = time.perf_counter()
+    step_time = start_time
+
+    def lap(step):
+        nonlocal step_time
+        now = time.perf_counter()
+        result["timings"][step] = round(now - step_time, 3)
+        step_time = now
+
+    try:
+        if job.get("threads"):
+            sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(int(job["threads"]))
+        maps = parameter_maps(job)
+        masks = mask_paths(job)
+        if any(masks.values()):
+            lap("masks")
+        result_image_path = job.get("outputs", {}).get("result_image")
+        interpolator = job.get("result_interpolator", "bspline")
+
+        key, cached_files, reverse_files = None, None, None
+        if job.get("cache", True):
+            cache_folder = job.get("cache_folder", cache_root)
+            key = _cache_key(job, maps, masks, cache_folder)
+            cached_files = lookup(key, cache_folder)
+            if cached_files is None and job.get("reuse_inverse", True):
+                reverse_files = lookup(_cache_key(job, maps, masks, cache_folder, reverse=True), cache_folder)
+            result["cache_key"], result["cached"] = key, cached_files is not None
+            lap("cache_lookup")
+
+        moving, registered, transform_maps = None, None, None
+        if cached_files is not None:
+            transform_maps = read_transform_chain(cached_files)
+        elif reverse_files is not None:
+            # The reversed pair was registered already: its inverse instead of a second registration, unless
+            # the field inversion did not converge
+            from Inverting_transforms import inverse_acceptance_mm, invert_chain
+            transform_maps, residual = invert_chain(read_transform_chain(reverse_files), sitk.ReadImage(job["fixed"]),
+                                                    folder)
+            lap("invert")
+            if residual <= inverse_acceptance_mm:
+                result["inverse_residual_mm"] = residual
+                result["inverted_from"] = os.path.dirname(reverse_files[0])
+            else:
+                result["inverse_rejected_mm"] = residual
+                transform_maps, reverse_files = None, None
+                field_file = os.path.join(folder, "InverseDeformationField.nii.gz")
+                if os.path.exists(field_file):
+                    os.remove(field_file)
+        if transform_maps is None:
+            transform_maps, moving, registered = _register(job, maps, masks, folder, lap, result)
+        result["transform_files"] = write_transform_chain(transform_maps, folder)
+        # an inverse field lives in the job folder, so only registrations are stored
+        if key is not None and cached_files is None and reverse_files is None:
+            store(key, cache_folder, result["transform_files"], job["name"])
+
+        if result_image_path:
+            os.makedirs(os.path.dirname(os.path.abspath(result_image_path)), exist_ok=True)
+            cached_image = cached_result_image(key, cache_folder, interpolator, result_image_path) if key else None
+            if cached_image is not None:
+                shutil.copyfile(cached_image, result_image_path)
+            else:
+                if registered is None:
+                    # the full-resolution moving image onto the full-resolution fixed grid
+                    moving = moving if moving is not None else sitk.ReadImage(job["moving"])
+                    registered = resample(moving, transform_maps, interpolator)
+                sitk.WriteImage(registered, result_image_path)
+                if key is not None:
+                    store_result_image(key, cache_folder, interpolator, result_image_path)
+            result["result_image"] = result_image_path
+            lap("resample")
+        result["status"] = "ok"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["seconds"] = round(time.perf_counter() - start_time, 3)
+
+    with open(os.path.join(folder, "job.json"), "w") as f:
+        json.dump(result, f, indent=1)
+    return result
+
+# Function to run many jobs in parallel
+def run_jobs(jobs, workers=num_workers):
+    """Runs the jobs in a process pool and returns their results, in the order of the jobs.
+    Jobs without a thread count share the cores: cores / workers threads each."""
+    results = {}
+    threads = max(1, num_cores // max(1, workers))
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(run_job, dict(job, threads=job.get("threads") or threads)): job["name"]
+                   for job in jobs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Registering"):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:  # the worker process died
+                results[futures[future]] = {"name": futures[future], "status": "failed",
+                                            "error": f"{type(e).__name__}: {e}", "timings": {}}
+            if results[futures[future]]["status"] != "ok":
+                logging.error(f"Registration {futures[future]} failed: {results[futures[future]]['error']}")
+    return [results[job["name"]] for job in jobs]
+
+def summarize(results):
+    """Returns counts, timings and the failed jobs."""
+    done = [r for r in results if r["status"] == "ok"]
+    seconds = sorted((r["seconds"] for r in done), reverse=True)
+    stages = [entry for r in done for entry in r.get("convergence", [])]
+    return {
+        "jobs": len(results),
+        "ok": len(done),
+        "failed": [{"name": r["name"], "error": r["error"]} for r in results if r["status"] != "ok"],
+        "total_job_seconds": round(sum(seconds), 1),
+        "mean_job_seconds": round(sum(seconds) / len(seconds), 1) if seconds else None,
+        "max_job_seconds": seconds[0] if seconds else None,
+        "iterations": sum(sum(entry["iterations"]) for entry in stages),
+        "useful_iterations": sum(sum(entry["useful_iterations"]) for entry in stages),
+    }
+
+# Function to build jobs from the series index
+def jobs_from_index(index_file, moving_role, fixed_role, **template):
+    """One job per patient that has both roles, e.g. jobs_from_index(path, "tof", "t1_3d", stages=[...]).
+    The template holds the other job keys; the result can be dumped into a job file with yaml.safe_dump."""
+    from Indexing_series import open_index, pairs_per_patient
+    with open_index(index_file) as conn:
+        return [dict(copy.deepcopy(template), name=f"{moving_role}_to_{fixed_role}_{patient}",
+                     fixed=fixed_series["nifti_path"], moving=moving_series["nifti_path"])
+                for patient, moving_series, fixed_series in pairs_per_patient(conn, moving_role, fixed_role)]
+
+if __name__ == "__main__":
+    logging.basicConfig(filename="registration_errors.log", level=logging.ERROR, format="%(asctime)s - %(message)s")
+    start_time = time.time()
+
+    jobs = load_jobs(sys.argv[1])
+    if len(sys.argv) > 2 and sys.argv[2] != "auto":
+        workers = int(sys.argv[2])
+    else:
+        from Scheduling_registration import schedule
+        jobs, workers = schedule(jobs)
+    results = run_jobs(jobs, workers)
+
+    summary = summarize(results)
+    summary["wall_seconds"] = round(time.time() - start_time, 1)
+    if jobs:
+        summary_folder = jobs[0].get("output_folder", output_root)
+        with open(os.path.join(summary_folder, "registration_summary.json"), "w") as f:
+            json.dump(dict(summary, results=results), f, indent=1)
+
+    print(f"{summary['ok']} of {summary['jobs']} registrations done in {summary['wall_seconds']} seconds "
+          f"(mean {summary['mean_job_seconds']} s, max {summary['max_job_seconds']} s per job)")
+    if summary["iterations"]:
+        print(f"{summary['useful_iterations']} of {summary['iterations']} elastix iterations before the metric "
+              f"plateaus")
+    for failure in summary["failed"]:
+        print(f"FAILED {failure['name']}: {failure['error']}")
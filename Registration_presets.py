@@ -0,0 +1,335 @@
+""" Speed/accuracy presets for the elastix stages, and the benchmark that measures them.
+
+A job of Registering_batch.py selects a preset with `preset: fast`; the preset is applied on top of
+sitk.GetDefaultParameterMap(stage) and under the job's own parameters. Presets set the pyramid
+(NumberOfResolutions), the sampler (ImageSampler, NumberOfSpatialSamples), the metric histogram
+(NumberOfHistogramBins) and the iterations per resolution, separately for linear and B-spline stages
+(a job can also give one preset per stage, e.g. {rigid: fast, affine: fast, bspline: fast}):
+
+    preset     resolutions  samples  bins  iterations (linear / bspline)  use
+    preview         2         1000    16        100 / 200                 visual checks, parameter tuning
+    fast            3         2000    24        200 / 300                 bulk cohort processing
+    balanced        4         2048    32        256 / 500                 close to the elastix defaults
+    accurate        4         8192    32       1000 / 1000                publication runs
+
+The fast deformable mode is the preview and fast B-spline presets: a coarse-to-fine control point grid
+(GridSpacingSchedule halving down to a final 20 / 12 mm instead of the default 8 mm), random samples redrawn
+every iteration (random sparse samples inside the fixed mask when the job has one, which also limits the
+B-spline stage to that ROI), a shorter pyramid, and mutual information without the bending energy penalty.
+Its threads are those of the job (see Scheduling_registration.py). Balanced and accurate keep the elastix
+default grid and penalty.
+
+Benchmark: python Registration_presets.py <reference_set.yaml> [stage ...]
+    runs every preset on every case of the reference set and reports seconds, Dice of the label images
+    and target registration error (TRE) of the landmarks, written to <reference_set>_benchmark.json.
+    The reference set lists cases of
+        name, fixed, moving, fixed_labels, moving_labels, fixed_landmarks, moving_landmarks
+    (labels and landmarks optional; landmarks are text files of physical x y z points in mm, one per line,
+    the same landmarks in the same order in both images).
+python Registration_presets.py --synthetic <folder> writes a synthetic reference set (phantom heads moved
+by known similarity transforms, with labels and landmarks) and benchmarks it.
+
+Measured on the synthetic set (python Registration_presets.py --synthetic <folder>: 4 cases, seed 0,
+translation + rigid + affine, 1 thread, 1.5 mm fixed and 1 mm moving grids):
+
+    preset     seconds/case  speedup  Dice    TRE mm (mean / max)
+    preview         2.8       32.6x   0.9996   0.10 / 0.32
+    fast            7.0       13.0x   0.9999   0.05 / 0.09
+    balanced        9.4        9.7x   0.9999   0.04 / 0.09
+    accurate       90.9        1.0x   0.9999   0.04 / 0.09
+
+python Registration_presets.py <reference_set.yaml> --initializer [stage ...] compares a translation stage
+with the moment (and geometry) initializer of Registering_batch.py in front of the same stages (default
+rigid + affine, balanced preset). On the synthetic set:
+
+    variant             seconds/case  speedup  Dice    TRE mm (mean / max)
+    translation stage        8.2        1.0x   0.9999   0.04 / 0.09
+    moments                  6.2        1.3x   0.9999   0.04 / 0.09
+    geometry                 6.3        1.3x   0.9999   0.04 / 0.09
+
+The initializer itself takes about 10 ms per job.
+
+python Registration_presets.py <reference_set.yaml> --deformable [preset ...] compares rigid + affine (fast)
+with the same followed by a B-spline stage of each preset, and reports the seconds the B-spline stage adds per
+case. With --synthetic the phantoms are also warped by a smooth random field of up to 4 mm (control points
+every 30 mm), which the affine stages cannot recover:
+
+    variant             seconds/case  speedup  Dice    TRE mm (mean / max)   B-spline cost
+    affine only              4.6        1.0x   0.8704   1.52 / 3.05
+    + bspline preview       12.3        0.4x   0.9643   0.51 / 1.13            +7.7 s
+    + bspline fast          21.1        0.2x   0.9942   0.28 / 0.89           +16.5 s
+    + bspline balanced     162.7        0.0x   0.9917   0.33 / 0.94          +158.1 s
+
+The phantoms are easy (Dice saturates and TRE stays below a quarter of a voxel for every preset),
+so these numbers rank the presets by cost only; whether accurate pays off on TOF, T1 and CTA has to be
+measured by running the benchmark on the annotated reference set of our data.
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+import SimpleITK as sitk
+import yaml
+
+linear_presets = {
+    "preview": {"NumberOfResolutions": 2, "NumberOfSpatialSamples": 1000, "NumberOfHistogramBins": 16,
+                "MaximumNumberOfIterations": 100},
+    "fast": {"NumberOfResolutions": 3, "NumberOfSpatialSamples": 2000, "NumberOfHistogramBins": 24,
+             "MaximumNumberOfIterations": 200},
+    "balanced": {"NumberOfResolutions": 4, "NumberOfSpatialSamples": 2048, "NumberOfHistogramBins": 32,
+                 "MaximumNumberOfIterations": 256},
+    "accurate": {"NumberOfResolutions": 4, "NumberOfSpatialSamples": 8192, "NumberOfHistogramBins": 32,
+                 "MaximumNumberOfIterations": 1000},
+}
+# Coarse-to-fine B-spline grids: the control point spacing of resolution r is FinalGridSpacingInPhysicalUnits
+# times entry r, halving from resolution to resolution down to the final spacing
+def grid_spacing_schedule(resolutions):
+    return [2.0 ** (resolutions - 1 - r) for r in range(resolutions)]
+
+# Mutual information alone, without the bending energy penalty of the default B-spline map (which triples the
+# time of a B-spline stage; the coarse final grid keeps the deformation smooth instead)
+unpenalized_metric = {"Registration": "MultiResolutionRegistration", "Metric": "AdvancedMattesMutualInformation"}
+
+bspline_presets = {
+    "preview": dict(linear_presets["preview"], MaximumNumberOfIterations=200, FinalGridSpacingInPhysicalUnits=20,
+                    GridSpacingSchedule=grid_spacing_schedule(2), **unpenalized_metric),
+    "fast": dict(linear_presets["fast"], MaximumNumberOfIterations=300, FinalGridSpacingInPhysicalUnits=12,
+                 GridSpacingSchedule=grid_spacing_schedule(3), **unpenalized_metric),
+    # the elastix default grid schedule and bending energy penalty
+    "balanced": dict(linear_presets["balanced"], MaximumNumberOfIterations=500),
+    "accurate": dict(linear_presets["accurate"], MaximumNumberOfIterations=1000),
+}
+# Random samples at arbitrary positions, redrawn every iteration (the stochastic gradient needs new samples)
+sampler_parameters = {"ImageSampler": "RandomCoordinate", "NewSamplesEveryIteration": "true"}
+
+# Function to get the parameters of a preset for a stage
+def preset_parameters(preset, stage):
+    """Parameters of the preset for the stage, to be set on top of the default parameter map."""
+    table = bspline_presets if stage == "bspline" else linear_presets
+    if preset not in table:
+        raise ValueError(f"Unknown registration preset {preset}, choose from {', '.join(table)}")
+    return dict(sampler_parameters, **table[preset])
+
+# Functions to build a synthetic reference set
+def _phantom(rng, size=(100, 120, 100), spacing=1.5):
+    """Head phantom: skull shell, textured brain, ventricles and a few spheres (labels 1 to 5)."""
+    z, y, x = np.meshgrid(*[(np.arange(n) - n / 2) * spacing for n in size[::-1]], indexing="ij")
+    head = (x / 68) ** 2 + (y / 82) ** 2 + (z / 66) ** 2
+    brain = (x / 60) ** 2 + (y / 74) ** 2 + (z / 58) ** 2 < 1
+    ventricles = ((np.abs(x) - 9) / 6) ** 2 + (y / 24) ** 2 + ((z - 8) / 10) ** 2 < 1
+    labels = np.where(brain, 1, 0).astype(np.uint8)
+    labels[ventricles] = 2
+    for label, center in zip((3, 4, 5), rng.uniform(-30, 30, size=(3, 3))):
+        labels[((x - center[0]) ** 2 + (y - center[1]) ** 2 + (z - center[2]) ** 2) < 8 ** 2] = label
+    texture = sitk.GetArrayFromImage(sitk.SmoothingRecursiveGaussian(
+        sitk.GetImageFromArray(rng.normal(size=labels.shape).astype(np.float32)), 3.0))
+    intensity = np.where((head < 1) & ~brain, 300.0, 0.0)  # scalp and skull
+    intensity[brain] = 100 + 400 * texture[brain]
+    intensity[labels == 2] = 20
+    intensity[labels >= 3] = 250
+    images = []
+    for array in (intensity.astype(np.float32), labels):
+        image = sitk.GetImageFromArray(array)
+        image.SetSpacing([spacing] * 3)
+        image.SetOrigin([-n / 2 * spacing for n in size])
+        images.append(image)
+    centroids = [np.array([x[labels == label].mean(), y[labels == label].mean(), z[labels == label].mean()])
+                 for label in (2, 3, 4, 5)]
+    return images[0], images[1], np.array(centroids)
+
+def _random_warp(rng, grid, warp_mm, control_spacing_mm=30.0):
+    """Smooth random displacement field on the grid with a largest displacement of warp_mm: random
+    displacements on control points every control_spacing_mm, interpolated with cubic B-splines."""
+    extent = np.array(grid.GetSize()) * np.array(grid.GetSpacing())
+    coarse_size = [int(np.ceil(e / control_spacing_mm)) + 1 for e in extent]
+    components = []
+    for _ in range(3):
+        coarse = sitk.GetImageFromArray(rng.normal(size=coarse_size[::-1]))
+        coarse.SetSpacing((extent / (np.array(coarse_size) - 1)).tolist())
+        coarse.SetOrigin(grid.GetOrigin())
+        components.append(sitk.GetArrayFromImage(sitk.Resample(coarse, grid, sitk.Transform(), sitk.sitkBSpline,
+                                                                0.0, sitk.sitkFloat64)))
+    field = np.stack(components, axis=-1)
+    field *= warp_mm / np.linalg.norm(field, axis=-1).max()
+    image = sitk.GetImageFromArray(field, isVector=True)
+    image.CopyInformation(grid)
+    return sitk.DisplacementFieldTransform(image)
+
+def _inverse_point(transform, point, iterations=50):
+    """y with transform(y) = point, by fixed-point iteration of a displacement field transform."""
+    point = np.asarray(point, float)
+    y = point.copy()
+    for _ in range(iterations):
+        y = point - (np.array(transform.TransformPoint(y.tolist())) - y)
+    return y
+
+def make_synthetic_reference_set(folder, n_cases=4, seed=0, warp_mm=0.0):
+    """Writes phantom cases whose moving image is the fixed phantom under a known similarity transform
+    (after a smooth random warp of up to warp_mm, if given), sampled on a finer 1 mm grid with noise, and
+    returns the path of the reference set file."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    cases = []
+    for i in range(n_cases):
+        fixed, fixed_labels, fixed_landmarks = _phantom(rng)
+        # S maps moving points to fixed points: moving(y) = fixed(S(y)), or fixed(S(W(y))) with the warp W
+        S = sitk.Similarity3DTransform()
+        S.SetRotation(rng.uniform(-1, 1, 3).tolist(), float(rng.uniform(-0.15, 0.15)))  # axis, angle
+        S.SetTranslation(rng.uniform(-8, 8, 3).tolist())
+        S.SetScale(float(rng.uniform(0.95, 1.05)))
+        grid = sitk.Image([130, 160, 130], sitk.sitkFloat32)
+        grid.SetOrigin([-65.0, -80.0, -65.0])
+        transform = S
+        if warp_mm:
+            W = _random_warp(rng, grid, warp_mm)
+            transform = sitk.CompositeTransform([S, W])  # W first, then S
+        moving = sitk.Resample(fixed, grid, transform, sitk.sitkLinear, 0.0)
+        moving = sitk.AdditiveGaussianNoise(moving, 10.0, 0.0, int(rng.integers(1 << 30)))
+        moving_labels = sitk.Resample(fixed_labels, grid, transform, sitk.sitkNearestNeighbor, 0)
+        moving_landmarks = np.array([S.GetInverse().TransformPoint(p.tolist()) for p in fixed_landmarks])
+        if warp_mm:
+            moving_landmarks = np.array([_inverse_point(W, p) for p in moving_landmarks])
+
+        case = {"name": f"synthetic_{i}"}
+        for key, image in (("fixed", fixed), ("fixed_labels", fixed_labels), ("moving", moving),
+                           ("moving_labels", moving_labels)):
+            case[key] = os.path.join(folder, f"synthetic_{i}_{key}.nii.gz")
+            sitk.WriteImage(image, case[key], useCompression=True)
+        for key, points in (("fixed_landmarks", fixed_landmarks), ("moving_landmarks", moving_landmarks)):
+            case[key] = os.path.join(folder, f"synthetic_{i}_{key}.txt")
+            np.savetxt(case[key], points, fmt="%.4f")
+        cases.append(case)
+    path = os.path.join(folder, "reference_set.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump({"cases": cases}, f, sort_keys=False)
+    return path
+
+# Functions to measure the accuracy of a registration
+def dice(fixed_labels, registered_labels):
+    """Mean Dice over the labels of the fixed label image."""
+    a, b = sitk.GetArrayViewFromImage(fixed_labels), sitk.GetArrayViewFromImage(registered_labels)
+    scores = [2 * np.sum((a == label) & (b == label)) / (np.sum(a == label) + np.sum(b == label))
+              for label in np.unique(a) if label != 0]
+    return float(np.mean(scores))
+
+def target_registration_error(chain, fixed_landmarks, moving_landmarks):
+    """Distances (mm) between the fixed landmarks mapped through the chain and the moving landmarks."""
+    from Composing_transforms import transform_points
+    mapped = transform_points(chain, np.loadtxt(fixed_landmarks, ndmin=2))
+    return np.linalg.norm(mapped - np.loadtxt(moving_landmarks, ndmin=2), axis=1)
+
+# Functions to benchmark the presets
+def benchmark_variants(cases, variants, output_folder=None, threads=1, reference=None):
+    """Registers every case with every variant (label -> job settings such as stages, preset, initializer),
+    one job at a time with the same number of threads. Returns one summary per variant (mean seconds,
+    speedup against the reference variant, Dice, TRE) with the per-case results."""
+    import tempfile
+    from Composing_transforms import load_chain
+    from Registering_batch import resample, run_job
+
+    output_folder = output_folder or tempfile.mkdtemp(prefix="preset_benchmark_")
+    summaries = []
+    for label, settings in variants.items():
+        rows = []
+        for case in cases:
+            job = {"name": f"{label}_{case['name']}", "fixed": case["fixed"], "moving": case["moving"],
+                   "output_folder": output_folder, "threads": threads, "cache": False}
+            result = run_job(dict(job, **settings))
+            row = {"case": case["name"], "status": result["status"], "seconds": result["seconds"]}
+            if result["status"] == "ok":
+                chain = load_chain(result["transform_files"][-1])
+                if case.get("fixed_labels") and case.get("moving_labels"):
+                    registered = resample(sitk.ReadImage(case["moving_labels"]), chain, "nearest")
+                    row["dice"] = dice(sitk.ReadImage(case["fixed_labels"]), registered)
+                if case.get("fixed_landmarks") and case.get("moving_landmarks"):
+                    errors = target_registration_error(chain, case["fixed_landmarks"], case["moving_landmarks"])
+                    row["tre_mean_mm"], row["tre_max_mm"] = float(errors.mean()), float(errors.max())
+            rows.append(row)
+        done = [row for row in rows if row["status"] == "ok"]
+        summary = {"variant": label, "cases": len(rows), "failed": len(rows) - len(done),
+                   "seconds": float(np.mean([row["seconds"] for row in done])) if done else None}
+        for key, reduce in (("dice", np.mean), ("tre_mean_mm", np.mean), ("tre_max_mm", np.max)):
+            values = [row[key] for row in done if key in row]
+            summary[key] = float(reduce(values)) if values else None
+        summaries.append(dict(summary, results=rows))
+    reference_seconds = next((s["seconds"] for s in summaries if s["variant"] == reference), None)
+    for summary in summaries:
+        summary["speedup"] = (reference_seconds / summary["seconds"]
+                              if reference_seconds and summary["seconds"] else None)
+    return summaries
+
+def benchmark_presets(cases, stages=("translation", "rigid", "affine"), presets=tuple(linear_presets),
+                      output_folder=None, threads=1, initializer=None):
+    """Every preset on the same stages, with speedups against accurate."""
+    variants = {preset: {"stages": list(stages), "preset": preset, "initializer": initializer}
+                for preset in presets}
+    return benchmark_variants(cases, variants, output_folder, threads, reference="accurate")
+
+def benchmark_deformable(cases, presets=("fast", "balanced"), linear_preset="fast", output_folder=None, threads=1):
+    """Affine-only registrations against the same ones followed by a B-spline stage of each preset, with the
+    time cost of the B-spline stage per case."""
+    affine = {"stages": ["rigid", "affine"], "preset": linear_preset, "initializer": "moments"}
+    variants = {"affine only": affine}
+    for preset in presets:
+        variants[f"+ bspline {preset}"] = dict(affine, stages=["rigid", "affine", "bspline"], preset={
+            "rigid": linear_preset, "affine": linear_preset, "bspline": preset})
+    summaries = benchmark_variants(cases, variants, output_folder, threads, reference="affine only")
+    for summary in summaries:
+        summary["extra_seconds"] = (summary["seconds"] - summaries[0]["seconds"]
+                                    if summary["seconds"] and summaries[0]["seconds"] else None)
+    return summaries
+
+def benchmark_initializer(cases, stages=("rigid", "affine"), preset="balanced", output_folder=None, threads=1):
+    """Translation stage against the moment initializer in front of the same stages, with speedups against
+    the translation stage."""
+    variants = {"translation stage": {"stages": ["translation"] + list(stages), "preset": preset},
+                "moments": {"stages": list(stages), "preset": preset, "initializer": "moments"},
+                "geometry": {"stages": list(stages), "preset": preset, "initializer": "geometry"}}
+    return benchmark_variants(cases, variants, output_folder, threads, reference="translation stage")
+
+def print_benchmark(summaries):
+    def show(value, digits):
+        return "-" if value is None else f"{value:.{digits}f}"
+    print("variant             seconds/case  speedup  Dice    TRE mm (mean / max)")
+    for s in summaries:
+        print(f"{s['variant']:<19} {show(s['seconds'], 1):>12}  {show(s['speedup'], 1):>6}x  {show(s['dice'], 4)}  "
+              f"{show(s['tre_mean_mm'], 2)} / {show(s['tre_max_mm'], 2)}"
+              + (f"  +{show(s['extra_seconds'], 1)} s" if "extra_seconds" in s else "")
+              + (f"  ({s['failed']} failed)" if s["failed"] else ""))
+
+if __name__ == "__main__":
+    import sys
+    start_time = time.time()
+    arguments = sys.argv[1:]
+    compare_initializer = "--initializer" in arguments
+    compare_deformable = "--deformable" in arguments
+    for flag in ("--initializer", "--deformable"):
+        if flag in arguments:
+            arguments.remove(flag)
+    if arguments[0] == "--synthetic":
+        # warped phantoms for the deformable benchmark, so that the B-spline stage has something to recover
+        reference_set = make_synthetic_reference_set(arguments[1], warp_mm=4.0 if compare_deformable else 0.0)
+        arguments = arguments[2:]
+    else:
+        reference_set, arguments = arguments[0], arguments[1:]
+    with open(reference_set) as f:
+        cases = yaml.safe_load(f)["cases"]
+
+    if compare_deformable:
+        stages = ["rigid", "affine", "bspline"]
+        summaries = benchmark_deformable(cases, presets=arguments or ("preview", "fast", "balanced"))
+        output = os.path.splitext(reference_set)[0] + "_deformable_benchmark.json"
+    elif compare_initializer:
+        stages = arguments or ["rigid", "affine"]
+        summaries = benchmark_initializer(cases, stages=stages)
+        output = os.path.splitext(reference_set)[0] + "_initializer_benchmark.json"
+    else:
+        stages = arguments or ["translation", "rigid", "affine"]
+        summaries = benchmark_presets(cases, stages=stages)
+        output = os.path.splitext(reference_set)[0] + "_benchmark.json"
+    print_benchmark(summaries)
+    with open(output, "w") as f:
+        json.dump({"reference_set": reference_set, "stages": stages, "variants": summaries}, f, indent=1)
+    print(f"Benchmark saved to {output} in {time.time() - start_time:.2f} seconds")
@@ -0,0 +1,128 @@
+""" Core-aware scheduling of registration jobs: elastix threads per job against jobs run at the same time.
+
+elastix uses every core for one job by default, but its speedup flattens well before that (the metric
+sampling and the optimizer steps are partly serial, and parallel jobs compete for memory bandwidth), so for
+a large batch several jobs with fewer threads each finish sooner than one job at a time with all cores.
+
+The best split is measured on the node: for every (threads, concurrency) with threads * concurrency = cores,
+`concurrency` short copies of a real job (one rigid stage, few iterations) run at the same time with
+`threads` threads each. The wall time of such a wave gives the makespan of a
+batch of N jobs as ceil(N / concurrency) * wave time (relative, since real jobs are longer than the
+benchmark), and the split with the smallest makespan is used. The calibration is saved per host and core
+count in calibration_file and reused.
+
+Usage: python Scheduling_registration.py registration_jobs.yaml   (calibrates and prints the choice)"""
+
+import json
+import math
+import os
+import platform
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from Registering_batch import num_cores, output_root, run_job
+
+calibration_file = os.path.join(output_root, "registration_calibration.json")
+
+# Benchmark job: a shortened rigid registration of real images
+benchmark_stage = "rigid"
+benchmark_parameters = {"NumberOfResolutions": 2, "MaximumNumberOfIterations": 64}
+
+# Function to list the splits of the cores
+def candidate_configs(cores=num_cores):
+    """(threads, concurrency) pairs with threads * concurrency = cores."""
+    return [(threads, cores // threads) for threads in range(1, cores + 1) if cores % threads == 0]
+
+# Function to run one wave of benchmark jobs
+def benchmark_config(fixed, moving, threads, concurrency):
+    """Runs `concurrency` benchmark registrations at once with `threads` threads each.
+    Returns the wall time of the wave and the mean registration time of its jobs."""
+    with tempfile.TemporaryDirectory() as folder:
+        jobs = [{"name": f"benchmark_{i}", "fixed": fixed, "moving": moving, "output_folder": folder,
+                 "threads": threads, "stages": [benchmark_stage], "parameters": benchmark_parameters,
+                 "cache": False}
+                for i in range(concurrency)]
+        with ProcessPoolExecutor(max_workers=concurrency) as executor:
+            start_time = time.perf_counter()
+            results = list(executor.map(run_job, jobs))
+            wave_seconds = time.perf_counter() - start_time
+    failed = [r["error"] for r in results if r["status"] != "ok"]
+    if failed:
+        raise RuntimeError(f"Benchmark registration failed: {failed[0]}")
+    return {
+        "threads": threads,
+        "concurrency": concurrency,
+        "wave_seconds": round(wave_seconds, 3),
+        "job_seconds": round(sum(r["timings"]["register"] for r in results) / len(results), 3),
+    }
+
+# Function to calibrate the node
+def calibrate(fixed, moving, cores=num_cores):
+    """Benchmarks every candidate split of the cores with the fixed and moving images of a real job."""
+    # Warm-up run, so that file caches and the first import do not count against the first split
+    benchmark_config(fixed, moving, cores, 1)
+    return {
+        "host": platform.node(),
+        "cores": cores,
+        "benchmark": {"fixed": fixed, "moving": moving, "stage": benchmark_stage, "parameters": benchmark_parameters},
+        "configs": [benchmark_config(fixed, moving, threads, concurrency)
+                    for threads, concurrency in candidate_configs(cores)],
+    }
+
+def load_calibration(path=calibration_file, cores=num_cores):
+    """Returns the saved calibration of this host and core count, or None."""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        calibrations = json.load(f)
+    return calibrations.get(f"{platform.node()}/{cores}")
+
+def save_calibration(calibration, path=calibration_file):
+    calibrations = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            calibrations = json.load(f)
+    calibrations[f"{calibration['host']}/{calibration['cores']}"] = calibration
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(calibrations, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+# Functions to choose the split for a batch
+def makespan(config, n_jobs):
+    """Relative makespan of n_jobs jobs: number of waves times the wave time."""
+    return math.ceil(n_jobs / config["concurrency"]) * config["wave_seconds"]
+
+def choose_config(calibration, n_jobs):
+    """The (threads, concurrency) split with the smallest makespan for n_jobs jobs.
+    For one job this is the fastest single job; for large batches the highest throughput."""
+    best = min(calibration["configs"], key=lambda config: (makespan(config, n_jobs), -config["threads"]))
+    return best["threads"], min(best["concurrency"], max(1, n_jobs))
+
+def schedule(jobs, path=calibration_file, cores=num_cores):
+    """Sets the thread count of the jobs that have none and returns (jobs, number of parallel jobs).
+    Calibrates with the images of the first job when this node has no calibration yet."""
+    if not jobs:
+        return jobs, 1
+    calibration = load_calibration(path, cores)
+    if calibration is None:
+        print(f"Calibrating registration threads on {cores} cores...")
+        calibration = calibrate(jobs[0]["fixed"], jobs[0]["moving"], cores)
+        save_calibration(calibration, path)
+    threads, concurrency = choose_config(calibration, len(jobs))
+    print(f"{len(jobs)} jobs: {concurrency} at a time with {threads} threads each")
+    return [dict(job, threads=job.get("threads") or threads) for job in jobs], concurrency
+
+if __name__ == "__main__":
+    import sys
+    from Registering_batch import load_jobs
+    jobs = load_jobs(sys.argv[1])
+    calibration = calibrate(jobs[0]["fixed"], jobs[0]["moving"])
+    save_calibration(calibration)
+    for config in calibration["configs"]:
+        print(f"{config['threads']:3d} threads x {config['concurrency']:3d} jobs: wave {config['wave_seconds']:.2f} s, "
+              f"{config['concurrency'] / config['wave_seconds']:.2f} jobs/s, "
+              f"makespan of {len(jobs)} jobs {makespan(config, len(jobs)):.1f} s (benchmark units)")
+    threads, concurrency = choose_config(calibration, len(jobs))
+    print(f"Chosen: {concurrency} jobs at a time with {threads} threads each")
@@ -0,0 +1,61 @@
+""" Summary of conversion_metrics.jsonl written by Converting_dcm_to_nii.py.
+
+Usage: python Summarizing_conversion_metrics.py <NIfTI output folder or metrics file> [all] [number of slowest series]
+By default only the last run is summarized: throughput (series/s, MB/s), time split, failures,
+dcm2niix warnings and the slowest series."""
+
+import json
+import os
+import sys
+from collections import Counter
+
+# Function to read the metric records
+def load_metrics(path):
+    if os.path.isdir(path):
+        path = os.path.join(path, "conversion_metrics.jsonl")
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Function to compute the summary of a list of records
+def summarize(records, n_slowest=10):
+    """Returns the throughput and the slowest series of the given records."""
+    done = [r for r in records if "wall_seconds" in r]
+    if not done:
+        return {"series": len(records), "failed": len(records)}
+    # Wall time of the run: from the first start to the last finish (series run in parallel)
+    span = max(r["finished_at"] for r in done) - min(r["finished_at"] - r["wall_seconds"] for r in done)
+    input_mb = sum(r.get("input_bytes", 0) for r in done) / 1024 ** 2
+    output_mb = sum(r.get("output_bytes", 0) for r in done) / 1024 ** 2
+    compression_seconds = sum(c["seconds"] for r in done for c in r.get("compression", []))
+    return {
+        "series": len(records),
+        "failed": sum(r.get("error") is not None for r in records),
+        "files": sum(r.get("n_files", 0) for r in done),
+        "input_mb": round(input_mb, 1),
+        "output_mb": round(output_mb, 1),
+        "run_seconds": round(span, 2),
+        "series_per_second": round(len(done) / max(span, 1e-9), 3),
+        "mb_per_second": round(input_mb / max(span, 1e-9), 1),
+        "sum_wall_seconds": round(sum(r["wall_seconds"] for r in done), 2),
+        "sum_cpu_seconds": round(sum(r["cpu_seconds"] for r in done), 2),
+        "sum_compression_seconds": round(compression_seconds, 2),
+        "series_with_warnings": sum(bool(r.get("warnings")) for r in done),
+        "exit_codes": dict(Counter(str(r.get("exit_code")) for r in done)),
+        "slowest": [(r["series"], r.get("output_name"), r["wall_seconds"], r.get("n_files"))
+                    for r in sorted(done, key=lambda r: r["wall_seconds"], reverse=True)[:n_slowest]],
+    }
+
+if __name__ == "__main__":
+    records = load_metrics(sys.argv[1])
+    if "all" not in sys.argv[2:] and records:
+        last_run = max(r.get("run", 0) for r in records)
+        records = [r for r in records if r.get("run", 0) == last_run]
+    n_slowest = next((int(arg) for arg in sys.argv[2:] if arg.isdigit()), 10)
+
+    summary = summarize(records, n_slowest)
+    slowest = summary.pop("slowest", [])
+    for key, value in summary.items():
+        print(f"{key:>24}: {value}")
+    print(f"\nSlowest {len(slowest)} series:")
+    for series, output_name, seconds, n_files in slowest:
+        print(f"{seconds:10.2f} s  {n_files:6} files  {output_name}  ({series})")